@@ -0,0 +1,163 @@
+"""Times flatfinder3's hot paths against synthetic listings and a local stand-in for every service it fetches from,
+so it runs offline and gives the same answers each time. Run it from the repo root with
+
+    python -m bench.run --sizes 1000 10000 100000 --out before.json
+
+and then, after a change,
+
+    python -m bench.run --sizes 1000 10000 100000 --out after.json --compare before.json
+
+which prints the slowdown on each benchmark and exits non-zero if any's worse than `--threshold`. Everything's
+built in a scratch directory, so your own caches are left alone.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+import numpy as np
+from flatfinder3 import dataframe, geo, grid, prices, server, store, tiles, webcat, zoopla
+from . import standin, synthetic
+
+REPO = Path(__file__).resolve().parent.parent
+
+TARGET = (51.49477, -0.05966)
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def timeit(f, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return times
+
+def record(results, name, size, times):
+    result = {'name': name, 'size': size, 'repeats': len(times), 'min': min(times), 'median': float(np.median(times))}
+    results.append(result)
+    print(f'{name:<20}{size or "":>8}{1000*result["median"]:12.1f}ms', file=sys.stderr)
+
+def setup(scratch):
+    """Moves into a scratch directory and points everything at the stand-in"""
+    os.chdir(scratch)
+    Path('credentials.json').write_text(json.dumps({'zoopla_key': 'synthetic'}))
+    standin.patch(standin.serve())
+    # The real budget's a hundred calls an hour
+    zoopla.BUCKET = zoopla.TokenBucket(Path('calls.json'), limit=2*10**9, burst=10**9, window=1)
+
+def fresh_store():
+    for suffix in ['', '-wal', '-shm']:
+        path = store.LISTINGS.with_name(store.LISTINGS.name + suffix)
+        if path.exists():
+            path.unlink()
+    # So the tables get made again on the next connection
+    store._prepared.discard(store.LISTINGS)
+
+def fixed(results, repeats):
+    """The benchmarks that don't depend on how many listings there are"""
+    record(results, 'cube', None, timeit(dataframe.cube, 1))
+    base = dataframe.basemap()
+
+    img = webcat.image(webcat.TIM(TARGET, travelTimeInterval=5), 12)[0]
+    def decode():
+        bands = geo.decode(img, webcat.COLORS)
+        return geo.fill(bands, bands == 255, 'min')
+    record(results, 'timmap.decode', None, timeit(decode, repeats))
+
+    record(results, 'prices.layer', None, timeit(lambda: prices.layer.__wrapped__(base), repeats))
+
+    thumbnail = lambda: tiles.png(tiles.thumbnail(base, *TARGET))
+    record(results, '_map', None, timeit(thumbnail, repeats))
+
+def sized(results, n, repeats):
+    """The benchmarks that grow with the number of listings"""
+    fresh_store()
+    raw = [store.compact(l) for l in synthetic.listings(n)]
+    record(results, 'store.upsert', n, timeit(lambda: store.upsert(raw), repeats))
+
+    cell = sorted(grid.cells())[0]
+    pages = iter(range(1, 10**6))
+    record(results, 'search_page', n, timeit(lambda: zoopla.search_page(cell, next(pages)), max(repeats, 5)))
+
+    record(results, 'listings', n, timeit(zoopla.listings, repeats))
+    ls = zoopla.listings()
+
+    record(results, 'dataframe', n, timeit(lambda: dataframe.dataframe(ls), repeats))
+    park = geo.layer(dataframe.cube(), 'park')
+    record(results, 'geo.lookup', n, timeit(lambda: geo.lookup(ls, park), repeats))
+
+    zoopla.save_snapshot(dataframe.finish(dataframe.enrich(dataframe.prefilter(ls))))
+    client = server.app.test_client()
+    record(results, 'server.render', n, timeit(lambda: client.get('/'), repeats))
+    record(results, 'api.listings', n, timeit(lambda: client.get('/api/listings'), repeats))
+    record(results, '_bigmap', n, timeit(lambda: server._bigmap('all').savefig(BytesIO(), format='png'), repeats))
+
+def compare(results, baseline, threshold):
+    """Prints each benchmark's slowdown against the baseline, and returns whether any's past the threshold"""
+    old = {(r['name'], r['size']): r['median'] for r in baseline['results']}
+    regressed = False
+    print(f'{"":<20}{"size":>8}{"before":>12}{"after":>12}{"ratio":>8}', file=sys.stderr)
+    for r in results:
+        key = (r['name'], r['size'])
+        if key not in old:
+            continue
+        ratio = r['median']/old[key]
+        flag = ' !' if ratio > threshold else ''
+        regressed = regressed or bool(flag)
+        print(f'{r["name"]:<20}{r["size"] or "":>8}{1000*old[key]:10.1f}ms{1000*r["median"]:10.1f}ms{ratio:8.2f}{flag}', file=sys.stderr)
+    return regressed
+
+def run(sizes=(1000, 10000, 100000), repeats=3):
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        cwd = os.getcwd()
+        try:
+            setup(scratch)
+            fixed(results, repeats)
+            for n in sizes:
+                sized(results, n, repeats)
+        finally:
+            os.chdir(cwd)
+
+    return {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of listings to benchmark with; goes up to 500000 comfortably')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--out', type=Path, help='where to write the JSON results; stdout if not given')
+    parser.add_argument('--compare', type=Path, help='results from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio that counts as a regression')
+    args = parser.parse_args()
+
+    # Keep the pipeline's progress messages out of the results
+    with contextlib.redirect_stdout(sys.stderr):
+        output = run(args.sizes, args.repeats)
+    text = json.dumps(output, indent=2)
+    if args.out:
+        args.out.write_text(text)
+    else:
+        print(text)
+
+    if args.compare and compare(output['results'], json.loads(args.compare.read_text()), args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
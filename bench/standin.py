@@ -0,0 +1,68 @@
+"""A local HTTP server that stands in for Zoopla, TfL, OSM, the price tiles and the shapefile downloads, and the
+patching that points flatfinder3 at it."""
+import json
+import re
+import threading
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+from flatfinder3 import geo, prices, webcat, zoopla
+from . import synthetic
+
+ROUTES = [
+    (r'/zoopla', lambda q: ('application/json', json.dumps(synthetic.zoopla_page(**q)).encode())),
+    (r'/river/(?P<river>\w+)', lambda q, river: ('text/plain', b'ok')),
+    (r'/tfl/(?P<river>\w+)/(?P<lat>[-.\d]+)/(?P<lon>[-.\d]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)',
+        lambda q, river, lat, lon, z, x, y: ('image/png', _tfl_tile(lat, lon, int(z), int(x), int(y)))),
+    (r'/osm/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+).png', lambda q, z, x, y: ('image/png', _osm_tile(int(z), int(x), int(y)))),
+    (r'/prices/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+).pbf',
+        lambda q, z, x, y: ('application/x-protobuf', _price_tile(int(z), int(x), int(y)))),
+    (r'/green_spaces.zip', lambda q: ('application/zip', _green_spaces())),
+    (r'/town_centres.zip', lambda q: ('application/zip', _town_centres())),
+    (r'/districts.json', lambda q: ('application/json', _districts())),
+]
+
+# Generating the responses isn't what's being measured, so they're only generated once
+_tfl_tile = lru_cache(None)(synthetic.tfl_tile)
+_osm_tile = lru_cache(None)(synthetic.osm_tile)
+_price_tile = lru_cache(None)(synthetic.price_tile)
+_green_spaces = lru_cache(None)(synthetic.green_spaces)
+_town_centres = lru_cache(None)(synthetic.town_centres)
+_districts = lru_cache(None)(synthetic.districts_json)
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        for pattern, route in ROUTES:
+            m = re.fullmatch(pattern, url.path)
+            if m:
+                mimetype, body = route(dict(parse_qsl(url.query)), **m.groupdict())
+                self.send_response(200)
+                self.send_header('Content-Type', mimetype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+        self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+def serve():
+    """Starts the stand-in on a free port in a background thread, and returns its address"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+def patch(host):
+    """Points every URL flatfinder3 fetches from at the stand-in"""
+    zoopla.ZOOPLA_URL = f'{host}/zoopla'
+    webcat.RIVER_URL = f'{host}/river/{{river}}'
+    webcat.URL = f'{host}/tfl/{{river}}/{{pinLat}}/{{pinLon}}/{{z}}/{{x}}/{{y}}?'
+    webcat.OSM_URL = f'{host}/osm/{{z}}/{{x}}/{{y}}.png'
+    prices.URL = f'{host}/prices/{{z}}/{{x}}/{{y}}.pbf'
+    geo.GREEN_SPACES_URL = f'{host}/green_spaces.zip'
+    geo.TOWN_CENTERS_URL = f'{host}/town_centres.zip'
+    prices.DISTRICTS_URL = f'{host}/districts.json'
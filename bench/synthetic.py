@@ -0,0 +1,174 @@
+"""Made-up but plausibly-shaped versions of everything flatfinder3 fetches: Zoopla listings, TfL travel-time tiles,
+OSM tiles, price vector tiles, and the green space, town centre and district shapefiles."""
+import zlib
+import zipfile
+import tempfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import shapely.geometry
+import mapbox_vector_tile
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+from flatfinder3 import geo, prices, webcat
+from flatfinder3.webcat import LONDON
+
+CLASSES = ['International', 'Metropolitan', 'Major', 'District', 'Neighbourhood']
+
+def _seed(*key):
+    # Not `hash`, since that's salted per process and the server and the benchmarks need to agree
+    return zlib.crc32(repr(key).encode())
+
+def _rng(*key):
+    return np.random.default_rng(_seed(*key))
+
+def _bounds():
+    """LONDON in Mercator, as (west, east, south, north)"""
+    (x1, x2), (y1, y2) = geo.mercator(np.array(LONDON[2:]), np.array(LONDON[:2]))
+    return x1, x2, y1, y2
+
+def listing(lid, lat, lon, published, rng):
+    """One listing as the API returns it - numbers as strings and all"""
+    beds = int(rng.integers(0, 5))
+    return {
+        'listing_id': str(lid),
+        'latitude': float(lat),
+        'longitude': float(lon),
+        'num_bedrooms': str(beds),
+        'num_bathrooms': str(max(1, beds - int(rng.integers(0, 2)))),
+        'rental_prices': {
+            'per_month': str(int(rng.integers(700, 4000))),
+            'shared_occupancy': 'Y' if rng.random() < .1 else 'N'},
+        'furnished_state': 'furnished' if rng.random() < .8 else 'unfurnished',
+        'property_type': rng.choice(['Flat', 'Terraced house', 'Studio']),
+        'first_published_date': published.strftime('%Y-%m-%d %H:%M:%S'),
+        'last_published_date': published.strftime('%Y-%m-%d %H:%M:%S'),
+        'displayable_address': f'{lid} Synthetic Street, London',
+        'details_url': f'https://www.zoopla.co.uk/to-rent/details/{lid}',
+        'description': 'A flat. ' * 50}
+
+def listings(n, seed=0, end='2020-08-01'):
+    """`n` listings scattered over London, published over the month up to `end`"""
+    rng = np.random.default_rng(seed)
+    lons = rng.uniform(LONDON[0], LONDON[1], n)
+    lats = rng.uniform(LONDON[2], LONDON[3], n)
+    published = pd.Timestamp(end) - pd.to_timedelta(rng.uniform(0, 30*24*3600, n), unit='s')
+    return [listing(i, lat, lon, p, rng) for i, (lat, lon, p) in enumerate(zip(lats, lons, published))]
+
+def zoopla_page(latitude, longitude, radius, page_number, page_size=100, result_count=5000, **kwargs):
+    """A page of a Zoopla area search. Listing IDs and publish times depend on the area and page, so refetching
+    a page gives the same listings and later pages give older ones."""
+    latitude, longitude, radius = float(latitude), float(longitude), float(radius)
+    page_number, page_size = int(page_number), int(page_size)
+    start = (page_number - 1)*page_size
+    count = max(0, min(page_size, result_count - start))
+
+    rng = _rng('zoopla', round(latitude, 4), round(longitude, 4), page_number)
+    dlat = radius*1.6/111
+    dlon = dlat/np.cos(np.radians(latitude))
+    base = _seed(round(latitude, 4), round(longitude, 4)) % 10**6 * 10**4
+    end = pd.Timestamp('2020-08-01') - pd.Timedelta(hours=page_number)
+    ls = [
+        listing(base + start + i, latitude + rng.uniform(-dlat, dlat), longitude + rng.uniform(-dlon, dlon),
+                end - pd.Timedelta(seconds=i), rng)
+        for i in range(count)]
+    return {'result_count': result_count, 'listing': ls}
+
+def tile_bounds(z, x, y):
+    size = 2*np.pi*geo.RADIUS/2**z
+    x1 = -np.pi*geo.RADIUS + x*size
+    y2 = np.pi*geo.RADIUS - y*size
+    return x1, x1 + size, y2 - size, y2
+
+def _png(img):
+    bs = BytesIO()
+    Image.fromarray(img).save(bs, format='png')
+    return bs.getvalue()
+
+def _centres(z, x, y, size=256):
+    x1, x2, y1, y2 = tile_bounds(z, x, y)
+    xs = x1 + (np.arange(size) + .5)*(x2 - x1)/size
+    ys = y2 - (np.arange(size) + .5)*(y2 - y1)/size
+    return np.meshgrid(xs, ys)
+
+def tfl_tile(lat, lon, z, x, y):
+    """Travel time bands that spread out in rings from the pin, in TfL's colors"""
+    px, py = geo.mercator(float(lat), float(lon))
+    xs, ys = _centres(z, x, y)
+    bands = (np.hypot(xs - px, ys - py)/2000).astype(int).clip(0, len(webcat.COLORS) - 1)
+    colors = np.array([[int(c[i:i+2], 16) for i in (1, 3, 5)] for c in webcat.COLORS], dtype=np.uint8)
+    return _png(colors[bands])
+
+def osm_tile(z, x, y):
+    """Blocks and roads, roughly as compressible as a real map tile"""
+    xs, ys = _centres(z, x, y)
+    blocks = ((xs // 400) + (ys // 400)) % 3
+    roads = (np.abs(xs % 400) < 20) | (np.abs(ys % 400) < 20)
+    img = np.full(xs.shape + (3,), 242, dtype=np.uint8)
+    img[blocks == 1] = (205, 235, 176)
+    img[roads] = (255, 255, 255)
+    return _png(img)
+
+def districts(rows=10, cols=12):
+    """A grid of postcode districts over London, each with a made-up price"""
+    x1, x2, y1, y2 = LONDON
+    xs, ys = np.linspace(x1, x2, cols + 1), np.linspace(y1, y2, rows + 1)
+    rng = _rng('districts')
+    records = []
+    for i in range(rows):
+        for j in range(cols):
+            name = f'D{i}{j:02d}'
+            box = shapely.geometry.box(xs[j], ys[i], xs[j+1], ys[i+1])
+            records.append({'name': name, 'id': name, 'price': float(rng.uniform(4000, 15000)), 'geometry': box})
+    return gpd.GeoDataFrame(records, crs='epsg:4326')
+
+def districts_json():
+    return districts().drop(columns='price').to_json().encode()
+
+def price_tile(z, x, y):
+    """A vector tile of the districts that overlap it, in the price layer's schema"""
+    x1, x2, y1, y2 = tile_bounds(z, x, y)
+    tile = shapely.geometry.box(x1, y1, x2, y2)
+    extent = 4096
+    ds = districts().to_crs('epsg:3857')
+    features = []
+    for _, d in ds.iterrows():
+        clipped = d.geometry.intersection(tile)
+        if clipped.is_empty:
+            continue
+        local = shapely.transform(clipped, lambda c: (c - [x1, y1])/(x2 - x1)*extent)
+        features.append({
+            'geometry': local.wkt,
+            'properties': {'PostDist': d['name'], 'price_by_postcode_district_price_per_sq_m': d.price}})
+    return mapbox_vector_tile.encode([{'name': prices.LAYER, 'features': features}])
+
+def _zipped(gdf, path):
+    """A zip of `gdf` as a shapefile at `path` within the archive"""
+    with tempfile.TemporaryDirectory() as tmp:
+        shp = Path(tmp) / path
+        shp.parent.mkdir(parents=True, exist_ok=True)
+        gdf.to_file(shp)
+        bs = BytesIO()
+        with zipfile.ZipFile(bs, 'w') as zf:
+            for f in shp.parent.iterdir():
+                zf.write(f, str(f.relative_to(tmp)))
+    return bs.getvalue()
+
+def green_spaces(n=800):
+    """Rectangular parks of a few hundred metres to a kilometre or so across"""
+    rng = _rng('green')
+    x1, x2, y1, y2 = _bounds()
+    xs, ys = rng.uniform(x1, x2, n), rng.uniform(y1, y2, n)
+    ws, hs = rng.uniform(150, 1500, n), rng.uniform(150, 1500, n)
+    boxes = [shapely.geometry.box(x, y, x + w, y + h) for x, y, w, h in zip(xs, ys, ws, hs)]
+    gdf = gpd.GeoDataFrame({'name': [f'park{i}' for i in range(n)]}, geometry=boxes, crs='epsg:3857')
+    return _zipped(gdf, 'Green spaces London/Green_spaces_excluding_private.shp')
+
+def town_centres(n=200):
+    rng = _rng('towns')
+    x1, x2, y1, y2 = _bounds()
+    points = shapely.points(rng.uniform(x1, x2, n), rng.uniform(y1, y2, n))
+    gdf = gpd.GeoDataFrame({'Classifi_1': rng.choice(CLASSES, n)}, geometry=points, crs='epsg:3857')
+    return _zipped(gdf, 'LP_2016_town_centre_points.shp')
@@ -1,19 +1,34 @@
-from cartopy import crs as ccrs
-from shapely.geometry import MultiPoint
-import numpy as np
-from . import webcat, zoopla, geo, server
-import matplotlib.pyplot as plt
+import importlib
 import subprocess
 
+# Imported on first use rather than here, so that importing the server doesn't drag in the plotting and geo 
+# libraries. `from flatfinder3 import *` still gets the lot.
+LAZY = {
+    'np': 'numpy',
+    'plt': 'matplotlib.pyplot',
+    'ccrs': 'cartopy.crs',
+    **{m: f'{__name__}.{m}' for m in ['dataframe', 'geo', 'grid', 'prices', 'server', 'store', 'tiles', 'webcat', 'zoopla']}}
+
+__all__ = [*LAZY, 'details_pages', 'cuts', 'decisions']
+
+def __getattr__(name):
+    if name in LAZY:
+        return importlib.import_module(LAZY[name])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 def details_pages(df):
     for _, r in df.sort_values('rental_prices.per_month').head(1).iterrows():
         subprocess.check_call(['open', r.details_url])
     
 def cuts():
-    layers = server.map_layers()
+    from cartopy import crs as ccrs
+    import matplotlib.pyplot as plt
+    from . import dataframe, geo, server
 
-    base = webcat.basemap()
-    cuts = server.CUTS
+    layers = dataframe.map_layers()
+
+    base = dataframe.basemap()
+    cuts = dataframe.CUTS
     fig, axes = plt.subplots(len(cuts)+1, 1, subplot_kw={'projection': ccrs.Mercator.GOOGLE})
     for ax, name in zip(axes.flatten(), cuts):
         ax.imshow(**base)
@@ -31,9 +46,13 @@ def cuts():
     fig.set_size_inches(10, (len(cuts)+1)*10)
 
 def decisions():
+    from cartopy import crs as ccrs
+    import matplotlib.pyplot as plt
+    from . import dataframe, server
+
     df = server.decision_dataframe()
 
-    base = webcat.basemap()
+    base = dataframe.basemap()
 
     ax = plt.axes(projection=ccrs.Mercator.GOOGLE)
     ax.figure.set_size_inches(10, 10)
@@ -1,9 +1,10 @@
-from . import webcat, geo, prices
+from . import webcat, geo, prices, store, metrics
 import pandas as pd
+import numpy as np
 import aljpy
 from pathlib import Path
-
-DECISIONS = Path('data/decisions.json')
+import json
+import hashlib
 
 CUTS = {
     'park': 10,
@@ -13,45 +14,120 @@ CUTS = {
     'aerial': 30,
     'central': 60}
 
-@aljpy.autocache(disk=False, memory=True)
-def map_layers():
-    base = webcat.basemap()
-    maps = aljpy.dotdict({
-        'park': geo.green_spaces(base), 
-        'town': geo.town_centers(base),
-        'propvalue': prices.layer(base)})
+FILTERS = {
+    'min_bedrooms': 1,
+    'max_bedrooms': 2,
+    'min_bathrooms': 1,
+    'max_price': 1500,
+    'since': '2020-07-01'}
+
+CUBES = Path('.cache/cubes')
+
+LAYER_SECONDS = metrics.histogram('flatfinder_layer_seconds', 'Time to build each map layer', ['layer'])
+
+def builders():
+    base = webcat.basemap
+    builders = {
+        'park': lambda: geo.green_spaces(base()), 
+        'town': lambda: geo.town_centers(base()),
+        'propvalue': lambda: prices.layer(base())}
 
     if geo.LOCATIONS:
-        maps.update({
-            'aerial': geo.aggtim(geo.LOCATIONS['aerial'].values(), 'min'), 
-            'central': geo.aggtim(geo.LOCATIONS['central'].values(), 'mean', interval=10), 
-            'friends': geo.aggtim(geo.LOCATIONS['friends'].values(), 'mean', interval=10)})
+        builders.update({
+            'aerial': lambda: geo.aggtim(geo.LOCATIONS['aerial'].values(), 'min'), 
+            'central': lambda: geo.aggtim(geo.LOCATIONS['central'].values(), 'mean', interval=10), 
+            'friends': lambda: geo.aggtim(geo.LOCATIONS['friends'].values(), 'mean', interval=10)})
 
-    return maps
+    return builders
 
-def dataframe(listings):
-    # Why is the API returning strings sometime?
-    listings['rental_prices.per_month'] = pd.to_numeric(listings['rental_prices.per_month'])
-
-    listings = (listings
-            .loc[lambda df: pd.to_numeric(df['num_bedrooms']) <= 2]
-            .loc[lambda df: pd.to_numeric(df['num_bedrooms']) > 0]
-            .loc[lambda df: pd.to_numeric(df['num_bathrooms']) >= 1]
-            .loc[lambda df: pd.to_numeric(df['rental_prices.per_month']) <= 1500]
+@metrics.autocache(disk=False, memory=True)
+def map_layers():
+    layers = aljpy.dotdict()
+    for k, b in builders().items():
+        with LAYER_SECONDS.time(layer=k):
+            layers[k] = b()
+    return layers
+
+def cube_key():
+    """Changes whenever the cube needs rebuilding"""
+    return json.dumps({'layers': sorted(builders()), 'locations': geo.LOCATIONS}, sort_keys=True)
+
+def layer_key():
+    """Changes whenever the enriched listings need recomputing from scratch"""
+    # The vector layers are in there because they're worked out differently to the ones looked up in the cube
+    return json.dumps({'cube': cube_key(), 'vectors': sorted(vectors()), 'fields': store.FIELDS}, sort_keys=True)
+
+@metrics.autocache(disk=False, memory=True)
+def cube():
+    """All the map layers resampled onto the basemap's grid and memory-mapped, so lookups, thresholds and combo 
+    maps are all just slicing, and all the server's workers share one copy"""
+    path = CUBES / hashlib.sha1(cube_key().encode()).hexdigest()[:12] / 'layers.npy'
+    if not (path.exists() and path.with_name('basemap.npy').exists()):
+        geo.save_cube(path, webcat.basemap(), map_layers())
+    return geo.load_cube(path)
+
+def basemap():
+    """The basemap as saved alongside the cube, so the server never has to build or unpickle it"""
+    c = cube()
+    return {'img': c.base, 'extent': c.extent, 'origin': c.origin}
+
+def prefilter(listings):
+    """The filters that never change. The rest are applied per-request by `select`."""
+    return (listings
             .loc[lambda df: df['rental_prices.shared_occupancy'] == 'N']
-            .loc[lambda df: df['furnished_state'] == 'furnished']
-            .loc[lambda df: pd.to_datetime(df['last_published_date']) > pd.Timestamp('2020-07-01')]).copy()
-    for k, m in map_layers().items():
-        listings[k] = geo.lookup(listings, m)
+            .loc[lambda df: df['furnished_state'] == 'furnished']).copy()
+
+def vectors():
+    """Layers that can be worked out exactly from their features, rather than looked up in the cube"""
+    return {'park': geo.green_space_features, 'town': geo.town_center_features}
 
-    df = listings
-    for k, c in CUTS.items():
+def enrich(listings):
+    values = geo.cube_lookups(listings, cube())
+    for k, features in vectors().items():
+        values[k] = geo.nearest_times(listings, features)
+    for k in values:
+        listings[k] = values[k]
+    return listings
+
+def update(enriched, listings):
+    """Merges freshly-fetched listings into an already-enriched frame, only looking up layers for the new ones"""
+    if not listings.size:
+        return enriched
+    fresh = enrich(prefilter(listings))
+    if enriched is None:
+        return fresh
+    stale = enriched.listing_id.isin(listings.listing_id)
+    frames = [enriched.loc[~stale], fresh]
+    # Each batch only has the categories that turned up in it, and concat falls back to objects if they differ
+    for k, dtype in store.FIELDS.items():
+        if dtype == 'category':
+            cats = pd.api.types.union_categoricals([f[k].astype('category') for f in frames]).categories
+            frames = [f.astype({k: pd.CategoricalDtype(cats)}) for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def select(df, cuts=CUTS, filters=FILTERS):
+    """Applies the cuts and filters to a frame that's been through `finish`. It's all vectorized comparisons 
+    against columns that were computed in advance, so it's quick enough to do per-request."""
+    filters = {**FILTERS, **filters}
+    mask = (
+        (df['num_bedrooms'].values >= filters['min_bedrooms']) &
+        (df['num_bedrooms'].values <= filters['max_bedrooms']) &
+        (df['num_bathrooms'].values >= filters['min_bathrooms']) &
+        (df['rental_prices.per_month'].values <= filters['max_price']) &
+        (df['last_published_date'].values > np.datetime64(pd.Timestamp(filters['since']))))
+    for k, c in cuts.items():
         if k in df:
-            df = df.loc[df[k] <= c]
-    df = df.copy()
+            mask &= (df[k].values <= c)
+    return df.loc[mask]
 
+def finish(enriched):
+    df = enriched.copy()
     df['nickname'] = df.listing_id.apply(aljpy.humanhash, n=2)
-    df['published'] = pd.to_datetime(df.last_published_date).dt.strftime('%a %-I:%M%p')
-    df = df.sort_values('last_published_date', ascending=False)
+    df['published'] = df.last_published_date.dt.strftime('%a %-I:%M%p')
+    # Ties are broken by ID so there's a fixed order to page through
+    df = df.sort_values(['last_published_date', 'listing_id'], ascending=[False, True], ignore_index=True)
         
-    return df
\ No newline at end of file
+    return df
+
+def dataframe(listings):
+    return select(finish(enrich(prefilter(listings))))
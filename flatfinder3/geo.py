@@ -1,20 +1,24 @@
-import cartopy.crs as ccrs
-from shapely.geometry import MultiPoint
 import numpy as np
-import matplotlib.pyplot as plt
-import geopandas as gpd
+import pandas as pd
 from zipfile import ZipFile
 import tempfile
-import shapely
-import rasterio.transform
-import rasterio.features
-import scipy.ndimage
 import requests
 from io import BytesIO
 import aljpy
-from . import webcat
+from . import webcat, lazy, metrics
 import json
+import os
+import multiprocessing
 from pathlib import Path
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+ccrs = lazy.module('cartopy.crs')
+mpl = lazy.module('matplotlib')
+gpd = lazy.module('geopandas')
+shapely = lazy.module('shapely')
+rasterio = lazy.module('rasterio')
+scipy = lazy.module('scipy')
 
 locations = Path('locations.json')
 if locations.exists():
@@ -22,32 +26,101 @@ if locations.exists():
 else:
     LOCATIONS = {}
 
+# Radius of the sphere that Web Mercator projects from
+RADIUS = 6378137.
+
+def mercator(lat, lon):
+    """Projects to Web Mercator, same as `ccrs.Mercator.GOOGLE` but vectorized"""
+    x = RADIUS*np.radians(lon)
+    y = RADIUS*np.log(np.tan(np.pi/4 + np.radians(lat)/2))
+    return x, y
+
+def pixels(x, y, img, extent, **kwargs):
+    """Fractional (row, col) of Mercator coords. Measured from bottom cause the origin's always 'lower'"""
+    h, w = img.shape[:2]
+    x1, x2, y1, y2 = extent
+    return h*(y - y1)/(y2 - y1), w*(x - x1)/(x2 - x1)
+
 def as_indices(coords, img, extent, **kwargs):
     """Coords should be (lat, lon)"""
+    i, j = pixels(*mercator(coords[..., 0], coords[..., 1]), img, extent)
+    return np.stack([i, j], -1).astype(int)
+
+def sample(mapdata, x, y, method='nearest'):
+    """Values of a map at Mercator coords, with NaNs for anywhere outside it. `method` is 'nearest' or 'bilinear'."""
+    img = mapdata['img']
     h, w = img.shape[:2]
-    x1, x2, y1, y2 = extent
+    i, j = pixels(x, y, **mapdata)
 
-    proj = np.array(ccrs.Mercator.GOOGLE.project_geometry(MultiPoint(coords[..., ::-1])))
+    if method == 'nearest':
+        i, j = i.astype(int), j.astype(int)
+        b = img[i.clip(0, h-1), j.clip(0, w-1)].astype(float)
+    else:
+        # Interpolate between pixel centres, holding the edge values out to the edge of the map
+        fi, fj = (i - .5).clip(0, h-1), (j - .5).clip(0, w-1)
+        i0, j0 = np.floor(fi).astype(int).clip(0, max(h-2, 0)), np.floor(fj).astype(int).clip(0, max(w-2, 0))
+        i1, j1 = (i0 + 1).clip(0, h-1), (j0 + 1).clip(0, w-1)
+        di, dj = fi - i0, fj - j0
+        b = np.zeros(len(i))
+        for ii, jj, wt in [(i0, j0, (1-di)*(1-dj)), (i0, j1, (1-di)*dj), (i1, j0, di*(1-dj)), (i1, j1, di*dj)]:
+            # Skip zero weights so infinite travel times don't turn into NaNs
+            b = b + np.where(wt > 0, wt*img[ii, jj], 0)
 
-    # Measured from bottom cause the origin's always 'lower'
-    j = (w*(proj[:, 0] - x1)/(x2 - x1))
-    i = (h*(proj[:, 1] - y1)/(y2 - y1))
+    b[(i < 0) | (i >= h)] = np.nan
+    b[(j < 0) | (j >= w)] = np.nan
+    return b
 
-    indices = np.stack([i, j], -1).astype(int)
+def lookup(listings, mapdata, method='nearest'):
+    return lookups(listings, {'value': mapdata}, method)['value'].values
 
-    return indices
+def lookups(listings, layers, method='nearest'):
+    """Looks up every layer for every listing, projecting the listings just the once"""
+    x, y = mercator(listings['latitude'].values.astype(float), listings['longitude'].values.astype(float))
+    return pd.DataFrame({k: sample(m, x, y, method) for k, m in layers.items()}, index=listings.index)
 
-def lookup(listings, mapdata, interval=5):
+def pack(rgb):
+    rgb = np.asarray(rgb).astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
 
-    coords = np.stack([listings['latitude'], listings['longitude']], -1)
-    indices = as_indices(coords, **mapdata)
+def decode(img, colors, missing=255):
+    """Maps each pixel of an RGB image to the index of its color in `colors`, or to `missing` if it's none of them"""
+    table = pack(np.round(255*np.array([mpl.colors.to_rgb(c) for c in colors])))
+    order = np.argsort(table)
+    keys = table[order]
 
-    h, w = mapdata['img'].shape[:2]
-    b = mapdata['img'][indices[:, 0].clip(0, h-1), indices[:, 1].clip(0, w-1)]
-    b[(indices[:, 0] < 0) | (indices[:, 0] >= h)] = np.nan
-    b[(indices[:, 1] < 0) | (indices[:, 1] >= w)] = np.nan
+    packed = pack(img[..., :3])
+    idx = np.searchsorted(keys, packed).clip(0, len(keys)-1)
+    return np.where(keys[idx] == packed, order[idx], missing).astype(np.uint8)
 
-    return b
+def fill(img, invalid, method='min'):
+    """Replaces each invalid pixel with the min (or max) of the valid pixels at the smallest chessboard distance 
+    from it. That's exactly what repeatedly applying a 3x3 grey erosion (or dilation) to the invalid pixels 
+    gives, but this visits each invalid pixel once rather than passing over the whole image per step."""
+    img = img.copy()
+    if invalid.all() or not invalid.any():
+        return img
+
+    h, w = img.shape
+    dist = scipy.ndimage.distance_transform_cdt(invalid, metric='chessboard')
+    reduce = np.minimum if method == 'min' else np.maximum
+    info = np.finfo if img.dtype.kind == 'f' else np.iinfo
+    blank = info(img.dtype).max if method == 'min' else info(img.dtype).min
+
+    idx = np.flatnonzero(invalid)
+    idx = idx[np.argsort(dist.flat[idx], kind='stable')]
+    levels = np.split(idx, np.flatnonzero(np.diff(dist.flat[idx])) + 1)
+    for level in levels:
+        k = dist.flat[level[0]]
+        i, j = np.divmod(level, w)
+        acc = np.full(len(level), blank, dtype=img.dtype)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                # Clipping at the edges is what the erosion's reflect mode amounts to at this window size
+                ni, nj = (i + di).clip(0, h-1), (j + dj).clip(0, w-1)
+                # Only pixels from earlier levels have been filled in
+                acc = reduce(acc, np.where(dist[ni, nj] < k, img[ni, nj], blank))
+        img[i, j] = acc
+    return img
 
 def transform(mapdata):
     shape = mapdata['img'].shape[:2]
@@ -63,61 +136,184 @@ def distances(base, shp):
 
     # Hand-calculated this scale. Should calculate it explicitly really.
     dist = 22*scipy.ndimage.distance_transform_edt(1 - img)
-    time = dist/(60*1.5)
+    time = walking_times(dist)
 
     return {'img': time, 'extent': base['extent'], 'origin': base['origin']}
 
-@aljpy.autocache('')
-def green_spaces(base, width=250):
+# Walking speed, in metres per second
+WALK = 1.5
+
+def walking_times(metres):
+    return metres/(60*WALK)
+
+SOURCES = Path('.cache/sources')
+GREEN_SPACES_URL = 'http://download1648.mediafire.com/uagkonyt1k3g/uvvwp9hjiatqyss/Green+spaces+London.zip'
+TOWN_CENTERS_URL = 'https://data.london.gov.uk/download/town-centre-locations/50e12a40-90c4-4a46-af20-9891d1441a5c/LP_2016_town_centre_points.zip'
+
+def source(name, fetch):
+    """Fetches, parses and filters a source dataset the once, then keeps it locally as GeoParquet - with bounding 
+    box columns for spatial filtering - so that anything derived from it can be rebuilt without the network"""
+    path = SOURCES / f'{name}.parquet'
+    if not path.exists():
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp = path.with_suffix('.tmp')
+        fetch().to_parquet(tmp, write_covering_bbox=True)
+        tmp.replace(path)
+    return gpd.read_parquet(path)
+
+def union(name, features):
+    """The union of a source's geometries, which is too slow to want to do more than once"""
+    def fetch():
+        fs = features()
+        return gpd.GeoDataFrame(geometry=[shapely.ops.unary_union(fs.values)], crs=fs.crs)
+    return source(f'{name}-union', fetch).geometry[0]
+
+def _green_spaces():
     """From: https://geospatialwandering.wordpress.com/2015/05/22/open-spaces-shapefile-for-london """
 
-    url = 'http://download1648.mediafire.com/uagkonyt1k3g/uvvwp9hjiatqyss/Green+spaces+London.zip'
-    r = requests.get(url)
+    r = requests.get(GREEN_SPACES_URL)
     with ZipFile(BytesIO(r.content)) as zf, \
             tempfile.TemporaryDirectory() as tmp:
         zf.extractall(tmp)
         shp = gpd.read_file(tmp + '/Green spaces London/Green_spaces_excluding_private.shp')
+    # Areas are taken before reprojecting, since Mercator blows them up by a factor of 2.6 or so at London's latitude
+    shp['area'] = shp.geometry.area
+    return shp[['area', 'geometry']].to_crs(ccrs.Mercator.GOOGLE.proj4_params)
 
-    shp = shp.geometry[shp.geometry.area > width**2]
-    shp = shapely.ops.unary_union(shp.to_crs(ccrs.Mercator.GOOGLE.proj4_params))
-    return distances(base, shp)
+def green_space_features(width=250):
+    """Green spaces of more than `width` metres squared. Every green space is kept locally, so a new width doesn't 
+    need the network."""
+    spaces = source('green_spaces', _green_spaces)
+    return spaces.geometry[spaces['area'] > width**2]
+
+@metrics.autocache('')
+def green_spaces(base, width=250):
+    return distances(base, union(f'green_spaces-{width}', lambda: green_space_features(width)))
 
-@aljpy.autocache()
 def _town_centers():
-    url = "https://data.london.gov.uk/download/town-centre-locations/50e12a40-90c4-4a46-af20-9891d1441a5c/LP_2016_town_centre_points.zip"
-    r = requests.get(url)
+    r = requests.get(TOWN_CENTERS_URL)
     with ZipFile(BytesIO(r.content)) as zf, \
             tempfile.TemporaryDirectory() as tmp:
         zf.extractall(tmp)
         shp = gpd.read_file(tmp + '/LP_2016_town_centre_points.shp')
-    return shp
+    shp = shp[shp['Classifi_1'].isin(['International', 'Metropolitan', 'Major', 'District'])]
+    return shp[['Classifi_1', 'geometry']].to_crs(ccrs.Mercator.GOOGLE.proj4_params)
+
+def town_center_features():
+    return source('town_centers', _town_centers).geometry
 
-@aljpy.autocache('')
+@metrics.autocache('')
 def town_centers(base):
-    shp = _town_centers()
-    shp = shp[shp['Classifi_1'].isin(['International', 'Metropolitan', 'Major', 'District'])]
-    shp = shp.geometry.to_crs(ccrs.Mercator.GOOGLE.proj4_params)
-    shp = shapely.ops.unary_union(shp)
-    return distances(base, shp)
+    return distances(base, union('town_centers', town_center_features))
+
+@metrics.autocache('{features.__name__}', disk=False, memory=True)
+def tree(features):
+    return shapely.STRtree(np.asarray(features().values))
+
+def nearest_times(listings, features):
+    """Exact walking times from each listing to the nearest of `features`, without going via a raster"""
+    lat = listings['latitude'].values.astype(float)
+    x, y = mercator(lat, listings['longitude'].values.astype(float))
+    (idx, _), dists = tree(features).query_nearest(shapely.points(x, y), return_distance=True, all_matches=False)
+
+    metres = np.full(len(lat), np.nan)
+    # Mercator stretches distances by 1/cos(lat), so scale them back down
+    metres[idx] = dists*np.cos(np.radians(lat[idx]))
+    return walking_times(metres)
+
+def warp(mapdata, dst_transform, dst_shape, nodata=0):
+    crs = ccrs.Mercator.GOOGLE.proj4_params
+    src_transform, _ = transform(mapdata)
+    dst = np.full(dst_shape, nodata, dtype=float)
+    rasterio.warp.reproject(mapdata['img'], dst, 
+        src_transform=src_transform, dst_transform=dst_transform,
+        src_crs=crs, dst_crs=crs, dst_nodata=nodata)
+    return dst
 
 def reproject(ref, *mapdata):
     dst_transform, dst_shape = transform(ref)
-    crs = ccrs.Mercator.GOOGLE.proj4_params
-    dsts = []
-    for m in mapdata:
-        src_transform, _ = transform(m)
-        dst = np.zeros(dst_shape)
-        rasterio.warp.reproject(m['img'], dst, 
-            src_transform=src_transform, dst_transform=dst_transform,
-            src_crs=crs, dst_crs=crs)
-        dsts.append(dst)
-    return np.stack(dsts)
+    return np.stack([warp(m, dst_transform, dst_shape) for m in mapdata])
 
 def threshold(mapdata, t):
     return {**mapdata, 'img': (mapdata['img'] <= t).astype(float)}
 
-def aggtim(targets, method, interval=5):
-    layers = [webcat.timmap(tuple(target), interval=interval) for target in targets]
-    stack = reproject(*layers)
-    return {**layers[0], 'img': getattr(stack, method)(0)}
-    
+def _timlayer(target, interval, dst_transform, dst_shape):
+    return warp(webcat.timmap(target, interval=interval), dst_transform, dst_shape)
+
+def _fold(acc, layer, weight, method):
+    if method == 'mean':
+        layer = weight*layer
+        return layer if acc is None else acc + layer
+    if acc is None:
+        return layer
+    return np.minimum(acc, layer) if method == 'min' else np.maximum(acc, layer)
+
+def aggtim(targets, method, interval=5, weights=None, workers=4):
+    """Combines the travel time maps of several targets with `method` - one of 'min', 'max' or 'mean', with 
+    `weights` giving a weighted mean. The maps are built in a process pool and folded into a running result as 
+    they arrive, so no more than `workers` of them are ever held at once. The workers are spawned rather than 
+    forked, since a forked one would share the connections `webcat.SESSION` has open from fetching the first map."""
+    targets = [tuple(t) for t in targets]
+    weights = np.ones(len(targets)) if weights is None else np.asarray(weights, dtype=float)
+    ref = webcat.timmap(targets[0], interval=interval)
+    dst = transform(ref)
+
+    acc, pending, queue = None, {}, iter(zip(targets, weights))
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        while True:
+            for target, weight in itertools.islice(queue, workers - len(pending)):
+                pending[pool.submit(_timlayer, target, interval, *dst)] = weight
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                acc = _fold(acc, future.result(), pending.pop(future), method)
+
+    if method == 'mean':
+        acc = acc/weights.sum()
+    return {**ref, 'img': acc}
+
+def save_cube(path, base, layers):
+    """Resamples every layer onto `base`'s grid and saves them as a single (layer, H, W) array, with a manifest 
+    and the basemap itself alongside. Anywhere a layer doesn't cover is NaN."""
+    dst_transform, dst_shape = transform(base)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    # Workers that start cold can all end up building it at once, so each writes its own files and renames them in
+    tmp = lambda p: p.with_name(f'{p.name}.{os.getpid()}.tmp')
+    cube = np.lib.format.open_memmap(tmp(path), mode='w+', dtype=np.float32, shape=(len(layers), *dst_shape))
+    for i, m in enumerate(layers.values()):
+        cube[i] = warp(m, dst_transform, dst_shape, nodata=np.nan)
+    cube.flush()
+    del cube
+
+    manifest = {'names': list(layers), 'extent': [float(e) for e in base['extent']], 'origin': base['origin'], 'shape': dst_shape}
+    tmp(path.with_suffix('.json')).write_text(json.dumps(manifest))
+    with open(tmp(path.with_name('basemap.npy')), 'wb') as f:
+        np.save(f, np.asarray(base['img']))
+
+    # The cube itself goes last, since it being there is what says the rest is
+    for p in [path.with_suffix('.json'), path.with_name('basemap.npy'), path]:
+        tmp(p).replace(p)
+
+def load_cube(path):
+    """Memory-maps a cube saved by `save_cube`, so every process reading it shares the one copy in the page cache"""
+    manifest = json.loads(path.with_suffix('.json').read_text())
+    return aljpy.dotdict({
+        **manifest, 
+        'version': path.parent.name, 
+        'img': np.load(path, mmap_mode='r'),
+        'base': np.load(path.with_name('basemap.npy'), mmap_mode='r')})
+
+def cube_lookups(listings, cube):
+    """Like `lookups`, but since a cube's layers are all on one grid the pixels only need working out once"""
+    x, y = mercator(listings['latitude'].values.astype(float), listings['longitude'].values.astype(float))
+    h, w = cube.img.shape[1:]
+    i, j = pixels(x, y, cube.img[0], cube.extent)
+    i, j = i.astype(int), j.astype(int)
+    values = np.asarray(cube.img[:, i.clip(0, h-1), j.clip(0, w-1)], dtype=float)
+    values[:, (i < 0) | (i >= h) | (j < 0) | (j >= w)] = np.nan
+    return pd.DataFrame(values.T, columns=cube.names, index=listings.index)
+
+def layer(cube, name):
+    """One layer of a cube in the usual mapdata form"""
+    return {'img': cube.img[cube.names.index(name)], 'extent': cube.extent, 'origin': cube.origin}
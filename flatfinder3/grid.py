@@ -0,0 +1,134 @@
+"""Adaptive quadtree over London for the Zoopla search.
+
+A cell's key is its path from the root: '' is the whole of `LONDON`, and each extra digit picks a quadrant -
+0 for SW, 1 for SE, 2 for NW, 3 for NE. Cells whose searches turn up more listings than can be paged through
+get split, and sets of sparse siblings get merged back into their parent."""
+import json
+import time
+import numpy as np
+from pathlib import Path
+from .webcat import LONDON
+from . import store
+
+PARTITION = Path('.cache/zoopla/cells.json')
+
+# How many listings the API will page through for one search
+CAPACITY = 100*100
+INITIAL_DEPTH = 2
+MAX_DEPTH = 6
+
+# Bounds on how often the scheduler refreshes a cell, in seconds
+MIN_INTERVAL = 5*60
+MAX_INTERVAL = 24*3600
+
+def children(key, bounds):
+    x1, x2, y1, y2 = bounds
+    xm, ym = (x1 + x2)/2, (y1 + y2)/2
+    return {
+        key + '0': (x1, xm, y1, ym),
+        key + '1': (xm, x2, y1, ym),
+        key + '2': (x1, xm, ym, y2),
+        key + '3': (xm, x2, ym, y2)}
+
+def initial():
+    cells = {'': tuple(LONDON)}
+    for _ in range(INITIAL_DEPTH):
+        cells = {k: b for key, bounds in cells.items() for k, b in children(key, bounds).items()}
+    return {k: {'bounds': b, 'count': None, 'refreshed': 0} for k, b in cells.items()}
+
+def cells():
+    if PARTITION.exists():
+        return json.loads(PARTITION.read_text())
+
+    # First run, so relabel any listings from the old fixed grid by where they are
+    partition = initial()
+    store.relabel(None, None)
+    for k, c in partition.items():
+        store.relabel(None, k, c['bounds'])
+    save(partition)
+    return partition
+
+def save(partition):
+    PARTITION.parent.mkdir(exist_ok=True, parents=True)
+    PARTITION.with_suffix('.tmp').write_text(json.dumps(partition))
+    PARTITION.with_suffix('.tmp').replace(PARTITION)
+
+def circle(bounds):
+    """Center as (lon, lat) and radius in miles of a circle covering the cell"""
+    x1, x2, y1, y2 = bounds
+    center = np.array([(x1 + x2)/2, (y1 + y2)/2])
+
+    y_km = 6400*2*np.pi/360*(y2 - y1)
+    x_km = 6400*2*np.pi/360*np.cos(np.pi/180*(y1 + y2)/2)*(x2 - x1)
+    rad = (y_km**2 + x_km**2)**.5 / 2 / 1.6 * 1.05 # Overdo it a bit
+
+    return center, rad
+
+def split(partition, key):
+    cell = partition.pop(key)
+    for k, b in children(key, cell['bounds']).items():
+        partition[k] = {'bounds': b, 'count': None, 'refreshed': cell.get('refreshed', 0)}
+        # The parent's search covered the child, so the child can pick up from where the parent got to
+        store.relabel(key, k, b)
+    print(f'{key!r}: split, {cell["count"]} listings')
+
+def merge(partition, parent):
+    keys = [k for k in partition if k[:-1] == parent]
+    x1 = min(partition[k]['bounds'][0] for k in keys)
+    x2 = max(partition[k]['bounds'][1] for k in keys)
+    y1 = min(partition[k]['bounds'][2] for k in keys)
+    y2 = max(partition[k]['bounds'][3] for k in keys)
+    refreshed = min(partition[k].get('refreshed', 0) for k in keys)
+    count = sum(partition.pop(k)['count'] for k in keys)
+    partition[parent] = {'bounds': (x1, x2, y1, y2), 'count': count, 'refreshed': refreshed}
+    # The merged cell can only pick up from the furthest-behind of its children
+    store.merge(keys, parent)
+    print(f'{parent!r}: merged, {count} listings')
+
+def repartition(counts):
+    """Takes the result counts from a pass over the cells, and splits the overfull ones and merges the sparse ones"""
+    partition = cells()
+    for k, c in counts.items():
+        if (k in partition) and (c is not None):
+            partition[k]['count'] = c
+            partition[k]['refreshed'] = time.time()
+
+    for k in [k for k, c in partition.items() if (c['count'] or 0) > CAPACITY]:
+        if len(k) < MAX_DEPTH:
+            split(partition, k)
+
+    parents = {k[:-1] for k in partition if k}
+    for p in parents:
+        siblings = [c for k, c in partition.items() if k and (k[:-1] == p)]
+        if (len(siblings) == 4) and all(c['count'] is not None for c in siblings):
+            if sum(c['count'] for c in siblings) <= CAPACITY/4:
+                merge(partition, p)
+
+    save(partition)
+    return partition
+
+def intervals(partition, rates, budget):
+    """How long to leave each cell between refreshes, given the rate of new listings in each and an hourly budget 
+    of API calls.
+
+    If a cell's refreshed once every `threshold` new listings, it costs about `rate/threshold` calls an hour for
+    the first page plus `rate/page_size` for the rest. Summing over cells and solving for the threshold that 
+    spends the whole budget gives the busiest cells the shortest intervals."""
+    total = sum(rates.get(k, 0) for k in partition)
+    # The quiet cells get refreshed every MAX_INTERVAL regardless
+    spare = budget - total/100 - len(partition)*3600/MAX_INTERVAL
+    threshold = total/spare if spare > 0 else np.inf
+
+    intervals = {}
+    for k in partition:
+        rate = rates.get(k, 0)
+        interval = 3600*threshold/rate if rate > 0 else np.inf
+        intervals[k] = float(np.clip(interval, MIN_INTERVAL, MAX_INTERVAL))
+    return intervals
+
+def due(partition, rates, budget):
+    """The cell that's next due a refresh, and how many seconds until it is"""
+    ints = intervals(partition, rates, budget)
+    due = {k: c.get('refreshed', 0) + ints[k] for k, c in partition.items()}
+    cell = min(due, key=due.get)
+    return cell, due[cell] - time.time()
@@ -0,0 +1,22 @@
+"""Stand-ins for the heavy geo and plotting libraries, so that importing the package - and the server in particular -
+doesn't pay for them until something actually needs them."""
+import importlib
+
+class module:
+    """Imports `name` the first time an attribute's looked up on it. Submodules that the parent doesn't import
+    itself - `rasterio.features`, say - get imported on lookup too."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        try:
+            return getattr(self._module, attr)
+        except AttributeError:
+            return importlib.import_module(f'{self._name}.{attr}')
+
+    def __repr__(self):
+        return f'<lazy module {self._name!r}>'
@@ -0,0 +1,163 @@
+"""Counters and histograms in the Prometheus text format, for the server's `/metrics` endpoint.
+
+The scraper runs in its own process, so it saves its metrics to `METRICS` as it goes and the server folds them in
+with a `process` label when it's scraped."""
+import json
+import math
+import os
+import time
+import threading
+import aljpy
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+METRICS = Path('.cache/metrics')
+
+# Seconds, spanning a fast request to a slow layer build
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 1800, math.inf)
+
+_lock = threading.Lock()
+REGISTRY = {}
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[l]) for l in self.labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, key, value):
+        yield self.name, {}, value
+
+class Histogram:
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[l]) for l in self.labels)
+        with _lock:
+            counts, total = self.values.get(key, ([0]*len(self.buckets), 0.))
+            counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, key, value):
+        counts, total = value
+        for b, c in zip(self.buckets, counts):
+            yield self.name + '_bucket', {'le': '+Inf' if b == math.inf else repr(float(b))}, c
+        yield self.name + '_sum', {}, total
+        yield self.name + '_count', {}, counts[-1]
+
+def _register(cls, name, help, labels, **kwargs):
+    with _lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = cls(name, help, labels, **kwargs)
+    return REGISTRY[name]
+
+def counter(name, help, labels=()):
+    return _register(Counter, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    return _register(Histogram, name, help, labels, buckets=buckets)
+
+CACHE_CALLS = counter('flatfinder_cache_calls_total', 'Calls to autocached functions', ['function'])
+CACHE_MISSES = counter('flatfinder_cache_misses_total', 'Calls to autocached functions that had to be computed', ['function'])
+STAGES = histogram('flatfinder_stage_seconds', 'Time spent in each stage of the pipeline', ['stage'])
+
+def autocache(*args, **kwargs):
+    """Same as `aljpy.autocache`, but counts the calls and the misses. The count of calls is taken outside the
+    cache and the count of misses inside it, so the difference is the hits."""
+    def decorator(f):
+        name = f'{f.__module__}.{f.__name__}'
+
+        @wraps(f)
+        def miss(*a, **kw):
+            CACHE_MISSES.inc(function=name)
+            return f(*a, **kw)
+        cached = aljpy.autocache(*args, **kwargs)(miss)
+
+        @wraps(f)
+        def call(*a, **kw):
+            CACHE_CALLS.inc(function=name)
+            return cached(*a, **kw)
+        call.clear = cached.clear
+        return call
+    return decorator
+
+def timed(stage):
+    """Decorator that records how long each call takes under `flatfinder_stage_seconds`"""
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            with STAGES.time(stage=stage):
+                return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+def state():
+    with _lock:
+        return {name: {
+            'type': m.type,
+            'help': m.help,
+            'labels': m.labels,
+            'buckets': [str(b) for b in getattr(m, 'buckets', [])],
+            'values': [[list(k), v] for k, v in m.values.items()]} for name, m in REGISTRY.items()}
+
+def save(process):
+    """Writes this process's metrics where the server can find them"""
+    METRICS.mkdir(exist_ok=True, parents=True)
+    path = METRICS / f'{process}.json'
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    tmp.write_text(json.dumps(state()))
+    tmp.replace(path)
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _line(name, labels, value):
+    labels = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return f'{name}{{{labels}}} {float(value)!r}' if labels else f'{name} {float(value)!r}'
+
+def render():
+    """This process's metrics, plus any saved by other processes, in the Prometheus text format"""
+    sources = [({}, state())]
+    if METRICS.exists():
+        for path in sorted(METRICS.glob('*.json')):
+            sources.append(({'process': path.stem}, json.loads(path.read_text())))
+
+    families = {}
+    for extra, states in sources:
+        for name, s in states.items():
+            families.setdefault(name, (s, []))[1].append((extra, s))
+
+    lines = []
+    for name, (first, members) in families.items():
+        lines.extend([f'# HELP {name} {first["help"]}', f'# TYPE {name} {first["type"]}'])
+        cls = Histogram if first['type'] == 'histogram' else Counter
+        for extra, s in members:
+            buckets = tuple(float(b) for b in s['buckets'])
+            metric = cls(name, s['help'], s['labels'], **({'buckets': buckets} if buckets else {}))
+            for key, value in s['values']:
+                labels = {**extra, **dict(zip(s['labels'], key))}
+                for sample, more, v in metric.samples(key, value):
+                    lines.append(_line(sample, {**labels, **more}, v))
+    return '\n'.join(lines) + '\n'
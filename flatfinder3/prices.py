@@ -1,55 +1,117 @@
 import requests
-import mapbox_vector_tile
 import json
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import pandas as pd
-import geopandas as gpd
 from io import BytesIO
-import aljpy
-import rasterio.features
-import scipy.ndimage
-from cartopy import crs as ccrs
-from . import geo
-
-@aljpy.autocache()
-def prices():
-    """From: https://houseprices.anna.ps/"""
-    url = 'https://b.tiles.mapbox.com/v4/annapowellsmith.2kq8mrxg/{z}/{x}/{y}.vector.pbf?access_token=pk.eyJ1Ijoid2hvb3duc2VuZ2xhbmQiLCJhIjoiY2l6ZDcwNW1uMDAzdjMyb3llczN6bDh6ZyJ9.laaDJGqsBHQLIZRy9dWlxA'
-    tiles = []
-    for x in [254, 255, 256]:
-        for y in [169, 170]:
-            r = requests.get(url.format(z=9, x=x, y=y))
-            if r.status_code == 200:
-                tiles.append(mapbox_vector_tile.decode(r.content))
+from . import geo, lazy, metrics
+from .webcat import LONDON
+
+mapbox_vector_tile = lazy.module('mapbox_vector_tile')
+shapely = lazy.module('shapely')
+gpd = lazy.module('geopandas')
+rasterio = lazy.module('rasterio')
+ccrs = lazy.module('cartopy.crs')
+
+URL = 'https://b.tiles.mapbox.com/v4/annapowellsmith.2kq8mrxg/{z}/{x}/{y}.vector.pbf?access_token=pk.eyJ1Ijoid2hvb3duc2VuZ2xhbmQiLCJhIjoiY2l6ZDcwNW1uMDAzdjMyb3llczN6bDh6ZyJ9.laaDJGqsBHQLIZRy9dWlxA'
+LAYER = 'postcode_sectors_englandgeojson'
+DISTRICTS_URL = 'https://www.opendoorlogistics.com/wp-content/uploads/Data/UK-postcode-boundaries-Jan-2015-topojson/Districts.json'
+TILES = Path('.cache/prices/tiles')
+WORKERS = 8
+
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=WORKERS))
+
+def tile_range(bounds=LONDON, zoom=9):
+    """The (z, x, y) of the slippy-map tiles covering a (west, east, south, north) box"""
+    x1, x2, y1, y2 = bounds
+    n = 2**zoom
+    col = lambda lon: int(np.floor((lon + 180)/360*n))
+    row = lambda lat: int(np.floor((1 - np.arcsinh(np.tan(np.radians(lat)))/np.pi)/2*n))
+    return [(zoom, x, y) for x in range(col(x1), col(x2)+1) for y in range(row(y2), row(y1)+1)]
+
+def _path(tile):
+    z, x, y = tile
+    return TILES / f'{z}/{x}/{y}.json'
 
+def _fetch(tile):
+    z, x, y = tile
+    r = SESSION.get(URL.format(z=z, x=x, y=y), timeout=30)
+    # Only a 404 means there's no tile. Anything else is left uncached so it's tried again next time.
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.content
+
+def _decode(content):
+    return mapbox_vector_tile.decode(content) if content is not None else {}
+
+def tiles(bounds=LONDON, zoom=9):
+    """Decoded vector tiles covering `bounds`. Missing ones are fetched concurrently and decoded in a process
+    pool, and each's cached as it comes in. The decoders are spawned rather than forked, since the fetchers are 
+    mid-request by the time they start."""
+    tiles = tile_range(bounds, zoom)
+    missing = [t for t in tiles if not _path(t).exists()]
+    if missing:
+        context = multiprocessing.get_context('spawn')
+        with ThreadPoolExecutor(WORKERS) as fetchers, ProcessPoolExecutor(mp_context=context) as decoders:
+            for tile, decoded in zip(missing, decoders.map(_decode, fetchers.map(_fetch, missing))):
+                path = _path(tile)
+                path.parent.mkdir(exist_ok=True, parents=True)
+                path.with_suffix('.tmp').write_text(json.dumps(decoded))
+                path.with_suffix('.tmp').replace(path)
+    return {t: json.loads(_path(t).read_text()) for t in tiles}
+
+def prices(bounds=LONDON, zoom=9):
+    """From: https://houseprices.anna.ps/"""
     props = []
-    for t in tiles: 
-        for f in t['postcode_sectors_englandgeojson']['features']:
+    for t in tiles(bounds, zoom).values(): 
+        for f in t.get(LAYER, {}).get('features', []):
             props.append(f['properties'])
     return pd.DataFrame(props)
 
-@aljpy.autocache()
-def shapes():
-    """Districts from: https://www.opendoorlogistics.com/downloads/"""
-    url = 'https://www.opendoorlogistics.com/wp-content/uploads/Data/UK-postcode-boundaries-Jan-2015-topojson/Districts.json'
-    r = requests.get(url)
-    return gpd.read_file(BytesIO(r.content)).set_index('name').drop('id', 1)
+def sectors(bounds=LONDON, zoom=9):
+    """The postcode sectors themselves, in Mercator coords, for rasterizing at sector rather than district level.
+    Sectors that straddle a tile boundary come as one piece per tile."""
+    geoms, props = [], []
+    for (z, x, y), t in tiles(bounds, zoom).items():
+        layer = t.get(LAYER, {})
+        size = 2*np.pi*geo.RADIUS/2**z
+        x0, y0 = -np.pi*geo.RADIUS + x*size, np.pi*geo.RADIUS - (y + 1)*size
+        scale = size/layer.get('extent', 4096)
+        for f in layer.get('features', []):
+            geom = shapely.geometry.shape(f['geometry'])
+            geoms.append(shapely.transform(geom, lambda c: c*scale + [x0, y0]))
+            props.append(f['properties'])
+    return gpd.GeoDataFrame(props, geometry=geoms, crs=ccrs.Mercator.GOOGLE.proj4_params)
 
-def data():
-    return shapes().merge(prices().groupby('PostDist').first(), left_index=True, right_index=True)
+def _shapes():
+    """Districts from: https://www.opendoorlogistics.com/downloads/"""
+    r = requests.get(DISTRICTS_URL)
+    shp = gpd.read_file(BytesIO(r.content)).set_index('name').drop(columns='id')
+    # Guess at the CRS
+    return shp.set_crs('epsg:4326', allow_override=True).to_crs(ccrs.Mercator.GOOGLE.proj4_params)
 
-@aljpy.autocache('')
-def layer(base):
-    t, shape = geo.transform(base)
+def shapes():
+    return geo.source('districts', _shapes)
 
-    # Guess at the CRS
-    d = data().set_crs('epsg:4326').to_crs(ccrs.Mercator.GOOGLE.proj4_params)
+def data(column='price_by_postcode_district_price_per_sq_m'):
+    ps = prices()[['PostDist', column]].dropna().drop_duplicates('PostDist').set_index('PostDist')
+    return shapes().merge(ps, left_index=True, right_index=True)
 
+def rasterize(base, geoms, values):
+    t, shape = geo.transform(base)
     # Flip it because rasterio expects a top origin
-    img = rasterio.features.rasterize([(r.geometry, r.price_by_postcode_district_price_per_sq_m) for _, r in d.iterrows()], out_shape=shape, transform=t)[::-1]
+    return rasterio.features.rasterize(zip(geoms, values), out_shape=shape, transform=t)[::-1]
+
+@metrics.autocache('')
+def layer(base):
+    d = data()
+    img = rasterize(base, d.geometry.values, d.price_by_postcode_district_price_per_sq_m.values)
 
     # Replace the boundaries - which are a mix of colors - with the nearest solid color
-    while (img == 0).any():
-        dilated = scipy.ndimage.grey_dilation(img, size=3)
-        img[img == 0] = dilated[img == 0]
+    img = geo.fill(img, img == 0, 'max')
     
     return {**base, 'img': img}
\ No newline at end of file
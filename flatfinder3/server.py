@@ -1,31 +1,86 @@
 from jinja2 import Template
-from flask import Flask, jsonify, make_response
-from . import zoopla, webcat, geo, dataframe
+from flask import Flask, Response, abort, jsonify, make_response, request, g
+from . import zoopla, dataframe, tiles, store, prices, metrics
 from pkg_resources import resource_string
-import pandas as pd
-import aljpy
 import numpy as np
-from cartopy import crs as ccrs
-import matplotlib.pyplot as plt
 from io import BytesIO
-import matplotlib as mpl
 import json
+import os
+import time
+import cProfile
 from pathlib import Path
+from functools import lru_cache
 
 app = Flask(__name__)
 
-DECISIONS = Path('data/decisions.json')
+LATENCY = metrics.histogram('flatfinder_request_seconds', 'Time to handle each request', ['endpoint', 'method', 'status'])
 
-def decision_dataframe():
-    df = zoopla.load_dataframe()
-    df['decision'] = pd.Series(decisions()).reindex(df.listing_id.values).fillna('').values
+# Setting FLATFINDER_PROFILE lets any request be profiled by adding `profile` to its query string
+PROFILE = bool(os.environ.get('FLATFINDER_PROFILE'))
+PROFILES = Path('.cache/profiles')
+
+@app.before_request
+def start():
+    g.start = time.perf_counter()
+    if PROFILE and ('profile' in request.args):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+@app.after_request
+def finish(response):
+    if 'profile' in g:
+        g.profile.disable()
+        PROFILES.mkdir(exist_ok=True, parents=True)
+        path = PROFILES / f'{request.endpoint}-{time.time_ns()}.prof'
+        g.profile.dump_stats(path)
+        response.headers.set('X-Profile', str(path))
+    LATENCY.observe(time.perf_counter() - g.start, endpoint=request.endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def exposition():
+    r = make_response(metrics.render())
+    r.headers.set('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    return r
+
+def decided(df):
+    df = df.copy()
+    df['decision'] = store.decisions().decision.reindex(df.listing_id.values).fillna('').values
     return df
 
+@lru_cache(maxsize=1)
+def _decision_dataframe(version, decision_version):
+    return decided(zoopla.snapshot(version))
+
+def decision_dataframe(version=None):
+    """The listings with the decisions joined on. Shared between requests until either changes, so don't modify it."""
+    version = zoopla.version() if version is None else version
+    return _decision_dataframe(version, store.decision_version())
+
+def params():
+    """Cuts and filters from the query string, falling back to the defaults in `dataframe`. Anything that doesn't 
+    parse is a 400."""
+    try:
+        cuts = {k: float(request.args.get(k, v)) for k, v in dataframe.CUTS.items()}
+        filters = {k: request.args.get(k, v) for k, v in dataframe.FILTERS.items()}
+        filters = {k: str(np.datetime64(v)) if k == 'since' else float(v) for k, v in filters.items()}
+    except ValueError:
+        abort(400)
+    return cuts, filters
+
+def pick(df, decision):
+    return df[df.decision == ''] if decision == 'all' else df[df.decision == decision]
+
+@lru_cache()
+def template():
+    return Template(resource_string(__package__, 'index.j2').decode())
+
 def render(decision, buttons):
-    df = decision_dataframe()
-    df = df[df.decision == ''] if decision == 'all' else df[df.decision == decision]
-    template = Template(resource_string(__package__, 'index.j2').decode())
-    return template.render(df=df.to_dict(orient='index'), buttons=buttons, decision=decision)
+    """Just the page - the listings themselves are fetched a page at a time from `/api/listings`"""
+    params()
+    # The travel-time layers, which is all of them bar the price per square metre
+    layers = [k for k in dataframe.CUTS if (k in dataframe.builders()) and (k != 'propvalue')]
+    return template().render(decision=decision, buttons=buttons, layers=layers, query=request.query_string.decode())
     
 @app.route('/')
 def index():
@@ -50,64 +105,144 @@ def photo(lid, filename):
     r.headers.set('Content-Type', f'image/{ext}')
     return r
 
-@aljpy.autocache()
-def _map(lat, lon, width=10):
-    y_km = 6400*2*np.pi/360
-    x_km = 6400*2*np.pi/360*np.cos(np.pi/180*lat)
-    xw = width/(2*x_km)
-    yw = width/(2*y_km)
+@app.route('/map/<lat>/<lon>')
+def map(lat, lon):
+    lat, lon = float(lat), float(lon)
+    r = make_response(tiles.cached(tiles.thumbnail_key(lat, lon), lambda: tiles.thumbnail(dataframe.basemap(), lat, lon)))
+    r.headers.set('Content-Type', 'image/png')
+    r.headers.set('Cache-Control', 'public, max-age=86400')
+    return r
+
+CARD = ['listing_id', 'nickname', 'details_url', 'latitude', 'longitude', 'rental_prices.per_month', 'num_bedrooms', 
+        'published', 'decision', *dataframe.CUTS]
+PAGE = 20
+MAX_PAGE = 200
 
-    fig = mpl.figure.Figure(dpi=100, figsize=(4.3, 4.3))
-    ax = fig.add_axes([0, 0, 1, 1], projection=ccrs.Mercator.GOOGLE, frameon=False)
+def version():
+    """Changes whenever anything that goes into `/api/listings` does"""
+    return f'{zoopla.version()}-{store.decision_version()}'
 
-    ax.imshow(**webcat.basemap())
-    ax.set_extent((lon-xw, lon+xw, lat-yw, lat+yw))
-    ax.scatter([lon], [lat], transform=ccrs.PlateCarree(), color='r')
+def after(df, cursor):
+    """The rows of `df` that come after the cursor, where the cursor's the publish time and ID of the last row of 
+    the previous page. Unlike an offset it stays put when new listings turn up or decisions drop others out."""
+    published, lid = cursor.split(':', 1)
+    published = np.datetime64(int(published), 'ns')
+    dates, lids = df.last_published_date.values, df.listing_id.values
+    return df.loc[(dates < published) | ((dates == published) & (lids > lid))]
 
-    bs = BytesIO()
-    fig.savefig(bs, format='png')
-    return bs.getvalue()
+def records(df, fields=CARD):
+    return df[[f for f in fields if f in df]].to_json(orient='records', date_format='iso')
 
-@app.route('/map/<lat>/<lon>')
-def map(lat, lon):
-    r = make_response(_map(float(lat), float(lon)))
-    r.headers.set('Content-Type', 'image/png')
+@app.route('/api/listings')
+def listings():
+    """A page of listings passing the cuts and filters in the query string. Takes `decision`, `cursor`, `limit` 
+    and a comma-separated list of `fields` alongside the cuts and filters."""
+    tag = tiles.etag(f'{version()}?{request.query_string.decode()}')
+    if tag in request.if_none_match:
+        return make_response('', 304)
+
+    cuts, filters = params()
+    snapshot = zoopla.version()
+    df = pick(dataframe.select(decision_dataframe(snapshot), cuts, filters), request.args.get('decision', 'all'))
+    total = len(df)
+    try:
+        if 'cursor' in request.args:
+            df = after(df, request.args['cursor'])
+        limit = max(1, min(int(request.args.get('limit', PAGE)), MAX_PAGE))
+    except (ValueError, OverflowError):
+        abort(400)
+
+    page, more = df.iloc[:limit], len(df) > limit
+    last = page.iloc[-1] if len(page) else None
+    cursor = f'{last.last_published_date.value}:{last.listing_id}' if more else None
+
+    fields = request.args['fields'].split(',') if 'fields' in request.args else CARD
+    body = records(page, fields)
+
+    r = make_response(f'{{"version": {json.dumps(snapshot)}, "total": {total}, "next": {json.dumps(cursor)}, "listings": {body}}}')
+    r.headers.set('Content-Type', 'application/json')
+    r.set_etag(tag)
     return r
 
-def decisions():
-    if not DECISIONS.exists():
-        DECISIONS.parent.mkdir(exist_ok=True, parents=True)
-        DECISIONS.write_text('{}')
-    return json.loads(DECISIONS.read_text())
+# How often the event stream checks for a new snapshot, and how often it sends something regardless, in seconds
+POLL = 2
+HEARTBEAT = 15
+
+def diff(old, new, cuts, filters, decision):
+    """The listings that have joined and left the view between two snapshots, as one SSE message"""
+    view = lambda v: pick(dataframe.select(decided(zoopla.snapshot(v)), cuts, filters), decision)
+    before, after = view(old), view(new)
+    added = after[~after.listing_id.isin(before.listing_id)]
+    removed = before.listing_id[~before.listing_id.isin(after.listing_id)]
+    data = f'{{"version": {json.dumps(new)}, "total": {len(after)}, "added": {records(added)}, "removed": {json.dumps(removed.tolist())}}}'
+    return f'id: {new}\nevent: diff\ndata: {data}\n\n'
+
+@app.route('/events')
+def events():
+    """Streams the changes to the view as new snapshots are written. Picks up from the snapshot in the 
+    `Last-Event-ID` header - which the browser sends itself on reconnecting - or else the `version` parameter. If 
+    that snapshot's already been cleared out or isn't a version at all, the client's told to start over."""
+    cuts, filters = params()
+    decision = request.args.get('decision', 'all')
+    last = request.headers.get('Last-Event-ID') or request.args.get('version') or zoopla.version()
+
+    def stream():
+        nonlocal last
+        # Gets the headers out straight away, and tells the browser how long to wait before reconnecting
+        yield f'retry: {int(1000*POLL)}\n\n'
+        beat = time.time()
+        while True:
+            current = zoopla.version()
+            if current != last:
+                try:
+                    # Versions are timestamps, and the client's one goes into a path, so anything else is a reset
+                    if not last.isdigit():
+                        raise FileNotFoundError(last)
+                    yield diff(last, current, cuts, filters, decision)
+                except FileNotFoundError:
+                    yield f'id: {current}\nevent: reset\ndata: {{}}\n\n'
+                last, beat = current, time.time()
+            elif time.time() > beat + HEARTBEAT:
+                yield ': heartbeat\n\n'
+                beat = time.time()
+            time.sleep(POLL)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/decide/<lid>/<decision>')
 def decide(lid, decision):
-    ds = decisions()
-    ds[lid] = decision
-    DECISIONS.write_text(json.dumps(ds))
+    store.decide(lid, decision)
     return ''
 
 @app.route('/decide/<lid>/')
 def reset(lid):
-    ds = decisions()
-    del ds[lid]
-    DECISIONS.write_text(json.dumps(ds))
+    store.undecide(lid)
     return ''
 
-@aljpy.autocache('{cuts}')
+@lru_cache(maxsize=32)
+def _cutmap(cuts):
+    cube = dataframe.cube()
+    mask = np.ones(cube.img.shape[1:], dtype=bool)
+    for name, cut in cuts:
+        if name in cube.names:
+            mask &= cube.img[cube.names.index(name)] <= cut
+    return mask.astype(float)
+
 def _combomap(cuts):
-    base = webcat.basemap()
-    layers = dataframe.map_layers()
-    common = set(cuts) & set(layers)
-    return geo.reproject(base, *[geo.threshold(layers[name], cuts[name]) for name in common]).all(0).astype(float)
+    """The overlay of everywhere that passes all the cuts. The most recently used few are kept in memory."""
+    return _cutmap(tuple(sorted(cuts.items())))
+
+def _bigmap(decision='all', df=None, cuts=None, filters={}):
+    from matplotlib.figure import Figure
+    from cartopy import crs as ccrs
 
-def _bigmap(decision='all', df=None):
-    df = decision_dataframe() if df is None else df
+    cuts = dataframe.CUTS if cuts is None else cuts
+    df = dataframe.select(decision_dataframe(), cuts, filters) if df is None else df
 
-    base = webcat.basemap()
-    combo = _combomap(dataframe.CUTS)
+    base = dataframe.basemap()
+    combo = _combomap(cuts)
 
-    fig = mpl.figure.Figure(dpi=100, figsize=(6.4, 6.4))
+    fig = Figure(dpi=100, figsize=(6.4, 6.4))
     ax = fig.add_axes([0, 0, 1, 1], projection=ccrs.Mercator.GOOGLE, frameon=False)
 
     if decision == 'all':
@@ -131,8 +266,88 @@ def _bigmap(decision='all', df=None):
     
 @app.route('/bigmap/<decision>')
 def bigmap(decision):
+    cuts, filters = params()
     bs = BytesIO()
-    _bigmap(decision).savefig(bs, format='png')
+    _bigmap(decision, cuts=cuts, filters=filters).savefig(bs, format='png')
     r = make_response(bs.getvalue())
     r.headers.set('Content-Type', 'image/png')
     return r
+
+def _tile(layer, cuts, z, x, y):
+    if layer == 'base':
+        base = dataframe.basemap()
+        return tiles.rgba(*tiles.cut(base['img'], base['extent'], z, x, y))
+
+    cube = dataframe.cube()
+    if layer == 'combo':
+        combo, valid = tiles.cut(_combomap(cuts), cube.extent, z, x, y)
+        # Shade everywhere that fails the cuts
+        alpha = np.where(valid & (combo == 0), 128, 0)
+        return np.stack([0*alpha, 0*alpha, 0*alpha, alpha], -1).astype(np.uint8)
+
+    values, valid = tiles.cut(cube.img[cube.names.index(layer)], cube.extent, z, x, y)
+    values = np.where(valid, values, np.nan)
+    return tiles.colorize(values, vmax=2*cuts[layer] if layer in cuts else np.nanmax(cube.img[cube.names.index(layer)]))
+
+@lru_cache(maxsize=1024)
+def _custom_tile(layer, relevant, z, x, y):
+    return tiles.png(_tile(layer, dict(relevant), z, x, y))
+
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.png')
+def tile(layer, z, x, y):
+    cuts, _ = params()
+    cube = dataframe.cube()
+    relevant = ()
+    if layer == 'base':
+        key = f'{cube.version}/base/{z}/{x}/{y}.png'
+    else:
+        if (layer != 'combo') and (layer not in cube.names):
+            return make_response('', 404)
+        # Only the cuts that change the tile go in the key
+        relevant = tuple(sorted(cuts.items())) if layer == 'combo' else tuple((k, v) for k, v in cuts.items() if k == layer)
+        spec = ','.join(f'{k}={v}' for k, v in relevant)
+        key = f'{cube.version}/{layer}/{spec}/{z}/{x}/{y}.png'
+
+    tag = tiles.etag(key)
+    if tag in request.if_none_match:
+        return make_response('', 304)
+
+    # Only the default cuts' tiles go on disk. Any other cuts are kept in memory, so the disk cache can't grow 
+    # without bound as people try out different values.
+    if all(dataframe.CUTS[k] == v for k, v in relevant):
+        content = tiles.cached(key, lambda: _tile(layer, cuts, z, x, y))
+    else:
+        content = _custom_tile(layer, relevant, z, x, y)
+
+    r = make_response(content)
+    r.headers.set('Content-Type', 'image/png')
+    r.headers.set('Cache-Control', 'public, max-age=3600')
+    r.set_etag(tag)
+    return r
+
+@app.route('/listings/<decision>.geojson')
+def geojson(decision):
+    cuts, filters = params()
+    df = dataframe.select(decision_dataframe(), cuts, filters)
+    if decision != 'all':
+        df = pick(df, decision)
+    columns = zip(df.longitude, df.latitude, df.listing_id, df.nickname, df.decision, df['rental_prices.per_month'])
+    features = [{
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+        'properties': {'listing_id': lid, 'nickname': nickname, 'decision': decision, 'price': float(price)}} 
+        for lon, lat, lid, nickname, decision, price in columns]
+    return jsonify({'type': 'FeatureCollection', 'features': features})
+
+def warm(zooms=range(9, 14)):
+    """Builds everything the server would otherwise build on its first few requests: the layer cube and the basemap
+    saved alongside it, the listings snapshot and its thumbnails, and the low-zoom tiles for the default cuts. The 
+    cube's directory is named for the layers that went into it, so a change of layers gets a fresh one."""
+    cube = dataframe.cube()
+    zoopla.cache_dataframe(photos=False)
+    client = app.test_client()
+    for z in zooms:
+        for _, x, y in prices.tile_range(zoom=z):
+            for layer in ('base', 'combo'):
+                client.get(f'/tiles/{layer}/{z}/{x}/{y}.png')
+    print(f'Warmed cube {cube.version}')
@@ -0,0 +1,254 @@
+"""SQLite-backed stores. One row per listing, upserted a page at a time, and one row per decision made in the UI."""
+import sqlite3
+import json
+import time
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import pandas as pd
+
+LISTINGS = Path('.cache/zoopla/listings.db')
+LEGACY = Path('.cache/zoopla/listings.json')
+DECISIONS = Path('data/decisions.db')
+LEGACY_DECISIONS = Path('data/decisions.json')
+
+SCHEMA = """
+pragma journal_mode=wal;
+create table if not exists listings (
+    listing_id text primary key,
+    cell text,
+    published text,
+    latitude real,
+    longitude real,
+    fetched real,
+    data text);
+create index if not exists listings_cell on listings (cell, published);
+"""
+
+DECISION_SCHEMA = """
+pragma journal_mode=wal;
+create table if not exists decisions (
+    listing_id text primary key,
+    decision text,
+    decided real);
+create table if not exists version (
+    id integer primary key check (id = 0),
+    version integer);
+insert or ignore into version values (0, 0);
+"""
+
+# The fields of a listing that are kept, and their types once loaded. Anything else the API returns is dropped
+FIELDS = {
+    'listing_id': 'object',
+    'grid_index': 'object',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'num_bedrooms': 'float32',
+    'num_bathrooms': 'float32',
+    'rental_prices.per_month': 'float32',
+    'rental_prices.shared_occupancy': 'category',
+    'furnished_state': 'category',
+    'property_type': 'category',
+    'first_published_date': 'datetime64[ns]',
+    'last_published_date': 'datetime64[ns]',
+    'displayable_address': 'object',
+    'details_url': 'object'}
+
+def _get(listing, field):
+    for k in field.split('.'):
+        listing = listing.get(k) if isinstance(listing, dict) else None
+    return listing
+
+def compact(listing):
+    """Flattens a listing from the API down to `FIELDS`, with the numbers as numbers - the API returns strings 
+    sometimes. Dates are left as strings so they sort and compare in SQL."""
+    flat = {}
+    for field, dtype in FIELDS.items():
+        value = _get(listing, field)
+        if dtype.startswith('float'):
+            value = pd.to_numeric(value, errors='coerce')
+            value = None if pd.isnull(value) else float(value)
+        flat[field] = value
+    return flat
+
+def typed(df):
+    """Applies `FIELDS` to a frame of listings, dropping any other columns"""
+    df = df.reindex(columns=list(FIELDS))
+    for field, dtype in FIELDS.items():
+        if dtype.startswith('float'):
+            df[field] = pd.to_numeric(df[field], errors='coerce').astype(dtype)
+        elif dtype.startswith('datetime'):
+            df[field] = pd.to_datetime(df[field], errors='coerce')
+        else:
+            df[field] = df[field].astype(dtype)
+    return df
+
+_prepared = set()
+_prepare_lock = threading.Lock()
+
+def _prepare(path):
+    """Creates the tables and runs any one-off migration. Only done on a process's first connection to each 
+    database, so after that reads are just reads and don't contend for the write lock."""
+    with _prepare_lock:
+        if path in _prepared:
+            return
+        path.parent.mkdir(exist_ok=True, parents=True)
+        conn = sqlite3.connect(str(path), timeout=60)
+        try:
+            conn.executescript(DECISION_SCHEMA if path == DECISIONS else SCHEMA)
+            (migrate_decisions if path == DECISIONS else migrate)(conn)
+        finally:
+            conn.close()
+        _prepared.add(path)
+
+@contextmanager
+def connect(path=LISTINGS):
+    if path not in _prepared:
+        _prepare(path)
+    conn = sqlite3.connect(str(path), timeout=60)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def _row(listing, fetched):
+    return (
+        str(listing['listing_id']),
+        str(listing['grid_index']),
+        listing['last_published_date'],
+        listing.get('latitude'),
+        listing.get('longitude'),
+        fetched,
+        json.dumps(listing))
+
+# Refetching a page mostly turns up listings that haven't changed, so `fetched` is only moved on for ones that 
+# have. The cell's left out of the comparison since the search circles overlap and a listing can turn up in either.
+UPSERT = """
+insert into listings values (?, ?, ?, ?, ?, ?, ?)
+on conflict (listing_id) do update set
+    cell = excluded.cell,
+    published = excluded.published,
+    latitude = excluded.latitude,
+    longitude = excluded.longitude,
+    data = excluded.data,
+    fetched = case 
+        when excluded.published is listings.published 
+            and json_remove(excluded.data, '$.grid_index') = json_remove(listings.data, '$.grid_index')
+        then listings.fetched 
+        else excluded.fetched end
+"""
+
+def _upsert(conn, listings, fetched):
+    conn.executemany(UPSERT, [_row(l, fetched) for l in listings])
+
+def upsert(listings, fetched=None):
+    with connect() as conn:
+        _upsert(conn, listings, time.time() if fetched is None else fetched)
+
+def latest(cell):
+    with connect() as conn:
+        [(published,)] = conn.execute('select max(published) from listings where cell = ?', (str(cell),)).fetchall()
+    return published
+
+def rates(days=7):
+    """Listings published per hour in each cell over the last few days"""
+    since = (pd.Timestamp.now() - pd.Timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    with connect() as conn:
+        rows = conn.execute('select cell, count(*) from listings where published > ? group by cell', (since,)).fetchall()
+    return {cell: n/(24*days) for cell, n in rows}
+
+def fetched(since):
+    """How many listings are new or have changed since `since`"""
+    with connect() as conn:
+        [(n,)] = conn.execute('select count(*) from listings where fetched > ?', (since,)).fetchall()
+    return n
+
+def relabel(old, new, bounds=None):
+    """Moves the listings in cell `old` - or in any cell, if it's None - that lie within `bounds` into cell `new`"""
+    query, params = 'update listings set cell = ? where 1', [new]
+    if old is not None:
+        query, params = query + ' and cell = ?', params + [old]
+    if bounds is not None:
+        x1, x2, y1, y2 = bounds
+        query, params = query + ' and longitude >= ? and longitude < ? and latitude >= ? and latitude < ?', params + [x1, x2, y1, y2]
+    with connect() as conn:
+        conn.execute(query, params)
+
+def merge(olds, new):
+    """Moves the listings from cells `olds` into `new`, but only up to the earliest of their latest listings"""
+    marks = ', '.join('?'*len(olds))
+    with connect() as conn:
+        conn.execute(f'''
+            update listings set cell = ? 
+            where cell in ({marks}) and published <= (
+                select min(latest) from (
+                    select max(published) as latest from listings where cell in ({marks}) group by cell
+                    ) having count(*) = ?)''', [new, *olds, *olds, len(olds)])
+
+def load(since=None):
+    query, params = 'select data from listings', ()
+    if since is not None:
+        query, params = query + ' where fetched > ?', (since,)
+    with connect() as conn:
+        rows = conn.execute(query, params).fetchall()
+    # Rows from before the schema was applied at ingestion are nested, so they need normalizing too
+    return typed(pd.json_normalize([json.loads(d) for d, in rows]))
+
+def migrate(conn):
+    """One-off import of the old whole-file JSON cache. The file's only checked for once the write lock's held, so 
+    if several processes start at once just the first imports it."""
+    with conn:
+        conn.execute('begin immediate')
+        if not LEGACY.exists():
+            return
+        _upsert(conn, json.loads(LEGACY.read_text()).values(), LEGACY.stat().st_mtime)
+        LEGACY.rename(LEGACY.with_suffix('.json.migrated'))
+
+def _bump(conn):
+    conn.execute('update version set version = version + 1')
+
+def decision_version():
+    """Goes up by one with every decision, so readers can tell when their cached copy's stale"""
+    with connect(DECISIONS) as conn:
+        [(version,)] = conn.execute('select version from version').fetchall()
+    return version
+
+_decisions = (None, None)
+
+def decisions():
+    """Every decision made so far as a frame indexed by listing ID. Only re-read when the version's moved on."""
+    global _decisions
+    version = decision_version()
+    if _decisions[0] != version:
+        with connect(DECISIONS) as conn:
+            # Read inside the same transaction as the version, so the two match
+            conn.execute('begin')
+            [(version,)] = conn.execute('select version from version').fetchall()
+            rows = conn.execute('select listing_id, decision, decided from decisions').fetchall()
+        df = pd.DataFrame(rows, columns=['listing_id', 'decision', 'decided']).set_index('listing_id')
+        df['decided'] = pd.to_datetime(df.decided, unit='s')
+        _decisions = (version, df)
+    return _decisions[1]
+
+def decide(lid, decision):
+    with connect(DECISIONS) as conn:
+        conn.execute('replace into decisions values (?, ?, ?)', (str(lid), decision, time.time()))
+        _bump(conn)
+
+def undecide(lid):
+    with connect(DECISIONS) as conn:
+        conn.execute('delete from decisions where listing_id = ?', (str(lid),))
+        _bump(conn)
+
+def migrate_decisions(conn):
+    """One-off import of the old whole-file JSON decisions. Like `migrate`, only the first process in does it."""
+    with conn:
+        conn.execute('begin immediate')
+        if not LEGACY_DECISIONS.exists():
+            return
+        decided = LEGACY_DECISIONS.stat().st_mtime
+        rows = [(str(k), v, decided) for k, v in json.loads(LEGACY_DECISIONS.read_text()).items()]
+        conn.executemany('replace into decisions values (?, ?, ?)', rows)
+        _bump(conn)
+        LEGACY_DECISIONS.rename(LEGACY_DECISIONS.with_suffix('.json.migrated'))
@@ -0,0 +1,110 @@
+"""Slippy-map tiles cut straight out of the rasters, for drawing with a client-side map library"""
+import numpy as np
+import hashlib
+import os
+import multiprocessing
+from PIL import Image, ImageDraw
+from io import BytesIO
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from .geo import RADIUS, mercator
+
+CACHE = Path('.cache/tiles')
+SIZE = 256
+
+# Thumbnails are THUMB pixels a side and cover WIDTH metres of ground
+THUMB = 430
+WIDTH = 10000
+
+# Green through yellow to red, for layers where lower is better
+STOPS = np.array([[26, 152, 80], [255, 255, 191], [215, 48, 39]])
+
+def bounds(z, x, y):
+    """Mercator (west, east, south, north) of a tile"""
+    size = 2*np.pi*RADIUS/2**z
+    x1 = -np.pi*RADIUS + x*size
+    y2 = np.pi*RADIUS - y*size
+    return x1, x1 + size, y2 - size, y2
+
+def window(img, extent, bounds, shape):
+    """Nearest-neighbour samples of a 'lower'-origin raster at the pixel centres of a Mercator window, top row 
+    first, along with a mask of which samples actually fall on the raster"""
+    h, w = img.shape[:2]
+    ex1, ex2, ey1, ey2 = extent
+    wx1, wx2, wy1, wy2 = bounds
+    rows, cols = shape
+
+    xs = wx1 + (np.arange(cols) + .5)*(wx2 - wx1)/cols
+    ys = wy2 - (np.arange(rows) + .5)*(wy2 - wy1)/rows
+    j = np.floor(w*(xs - ex1)/(ex2 - ex1)).astype(int)
+    i = np.floor(h*(ys - ey1)/(ey2 - ey1)).astype(int)
+
+    valid = ((i >= 0) & (i < h))[:, None] & ((j >= 0) & (j < w))[None, :]
+    return img[i.clip(0, h-1)[:, None], j.clip(0, w-1)[None, :]], valid
+
+def cut(img, extent, z, x, y):
+    return window(img, extent, bounds(z, x, y), (SIZE, SIZE))
+
+def colorize(values, vmax, alpha=160):
+    frac = np.nan_to_num(values/vmax, nan=1., posinf=1.).clip(0, 1)
+    rgb = np.stack([np.interp(frac, [0, .5, 1], STOPS[:, c]) for c in range(3)], -1)
+    a = np.where(np.isnan(values), 0, alpha)
+    return np.concatenate([rgb, a[..., None]], -1).astype(np.uint8)
+
+def rgba(rgb, valid):
+    return np.concatenate([rgb[..., :3], 255*valid[..., None]], -1).astype(np.uint8)
+
+def png(rgba):
+    bs = BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(bs, format='png')
+    return bs.getvalue()
+
+def etag(key):
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def cached(key, render):
+    """The PNG for `key` from the disk cache, rendering it if it's not there yet"""
+    path = CACHE / key
+    if not path.exists():
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp = path.with_name(path.name + f'.{os.getpid()}.tmp')
+        tmp.write_bytes(png(render()))
+        tmp.replace(path)
+    return path.read_bytes()
+
+def thumbnail(base, lat, lon, width=WIDTH, size=THUMB):
+    """A `width`-metre square of the basemap around a listing, with the listing marked in red"""
+    x, y = mercator(lat, lon)
+    # Mercator stretches distances by 1/cos(lat)
+    half = width/2/np.cos(np.radians(lat))
+    img, valid = window(base['img'], base['extent'], (x - half, x + half, y - half, y + half), (size, size))
+
+    im = Image.fromarray(rgba(img, valid), 'RGBA')
+    c, r = size/2, size/100
+    ImageDraw.Draw(im).ellipse((c - r, c - r, c + r, c + r), fill=(255, 0, 0, 255))
+    return np.asarray(im)
+
+def thumbnail_key(lat, lon):
+    return f'thumbs/{lat:.5f}/{lon:.5f}.png'
+
+_BASE = None
+
+def _init(base):
+    global _BASE
+    _BASE = base
+
+def _prerender(latlon):
+    lat, lon = latlon
+    cached(thumbnail_key(lat, lon), lambda: thumbnail(_BASE, lat, lon))
+
+def prerender(df, base, workers=4):
+    """Renders the thumbnails for every listing in `df` that doesn't have one yet. The basemap's handed to each 
+    worker once, up front. The workers are spawned rather than forked, since the scraper's photo prefetching 
+    threads are likely to be mid-request at the time."""
+    latlons = {(lat, lon) for lat, lon in zip(df.latitude, df.longitude)}
+    latlons = [ll for ll in latlons if not (CACHE / thumbnail_key(*ll)).exists()]
+    if latlons:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init, initargs=(base,)) as pool:
+            list(pool.map(_prerender, latlons, chunksize=64))
+    return len(latlons)
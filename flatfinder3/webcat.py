@@ -1,12 +1,18 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import scipy.ndimage
-from cartopy.io.img_tiles import GoogleWTS, OSM
 import urllib.parse
 import aljpy
-from cartopy import crs as ccrs
 import requests
+from PIL import Image
+from io import BytesIO
+from pathlib import Path
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from . import geo, lazy, metrics
+
+plt = lazy.module('matplotlib.pyplot')
+ccrs = lazy.module('cartopy.crs')
+img_tiles = lazy.module('cartopy.io.img_tiles')
+shapely = lazy.module('shapely')
 
 # ((bot, left), (top, right))
 LONDON = (-.489, .236, 51.28, 51.686)
@@ -16,51 +22,108 @@ PARAMS = dict(
     modeId='All',)
 COLORS = ['#460000', '#ED1C24', '#F26522', '#FFF200', '#8DC73F', '#1C9959', '#00AEEF', '#0054A6', '#8686BE', '#662D91', '#000000']
 
-URL = 'https://api-{river}.tfl.gov.uk/TravelTimes/Average/{pinLat}/{pinLon}/tile/{z}/{x}/{y}?'
+RIVER_URL = 'https://api-{river}.tfl.gov.uk'
+URL = RIVER_URL + '/TravelTimes/Average/{pinLat}/{pinLon}/tile/{z}/{x}/{y}?'
+OSM_URL = 'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png'
 
-@aljpy.autocache(disk=False, memory=True, duration=3600)
+TILES = Path('.cache/webcat/tiles')
+WORKERS = 8
+# OSM's tile usage policy asks for no more than a couple of connections at once
+OSM_WORKERS = 2
+
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=WORKERS))
+# OSM's policy also asks for a user agent that identifies the app
+SESSION.headers['User-Agent'] = 'flatfinder3 (+https://github.com/andyljones/flatfinder3)'
+
+@metrics.autocache(disk=False, memory=True, duration=3600)
 def river():
     # TfL seems to rotate its API server, declaring that the two which aren't active are 'blocked'
     for river in ['nile', 'tigris', 'ganges']:
-        url = f'https://api-{river}.tfl.gov.uk'
-        r = requests.get(url)
+        url = RIVER_URL.format(river=river)
+        r = SESSION.get(url, timeout=30)
         if r.status_code == 200:
             return river
     raise ValueError('All three servers failed; check "https://api-tigris.tfl.gov.uk" and the alternatives yourself')
 
-class TIM(GoogleWTS):
-
-    def __init__(self, target, **kwargs):
-        super().__init__()
-        self._pin = {'pinLat': target[0], 'pinLon': target[1]}
-        self._kwargs = kwargs
-
-    def _image_url(self, tile):
-        x, y, z = tile
-        url = URL.format(**self._pin, z=z, x=x, y=y, river=river()) + urllib.parse.urlencode({**PARAMS, **self._kwargs})
-        return url
-
-@aljpy.autocache()
+@lru_cache()
+def imagery():
+    """The tile sources. They subclass cartopy's, so they're defined on first use rather than at import."""
+
+    class TIM(img_tiles.GoogleWTS):
+
+        def __init__(self, target, **kwargs):
+            super().__init__()
+            self._pin = {'pinLat': target[0], 'pinLon': target[1]}
+            self._kwargs = kwargs
+            self.key = f'tim/{target[0]}_{target[1]}/' + urllib.parse.urlencode(sorted(kwargs.items()))
+
+        def _image_url(self, tile):
+            x, y, z = tile
+            url = URL.format(**self._pin, z=z, x=x, y=y, river=river()) + urllib.parse.urlencode({**PARAMS, **self._kwargs})
+            return url
+
+    class Basemap(img_tiles.OSM):
+        key = 'osm'
+        workers = OSM_WORKERS
+
+        def _image_url(self, tile):
+            x, y, z = tile
+            return OSM_URL.format(z=z, x=x, y=y)
+
+    return aljpy.dotdict(TIM=TIM, Basemap=Basemap)
+
+def TIM(target, **kwargs):
+    return imagery().TIM(target, **kwargs)
+
+def Basemap():
+    return imagery().Basemap()
+
+def fetch_tile(imagery, tile):
+    """Fetches a single tile, caching the decoded array on disk. Returns None for tiles the server doesn't have."""
+    x, y, z = tile
+    path = TILES / imagery.key / f'{z}/{x}/{y}.npy'
+    missing = path.with_suffix('.missing')
+    if path.exists():
+        img = np.load(path)
+    elif missing.exists():
+        return None
+    else:
+        r = SESSION.get(imagery._image_url(tile), timeout=30)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        if r.status_code == 404:
+            missing.touch()
+            return None
+        r.raise_for_status()
+        img = np.array(Image.open(BytesIO(r.content)).convert('RGB'))
+        with open(path.with_suffix('.tmp'), 'wb') as f:
+            np.save(f, img)
+        path.with_suffix('.tmp').replace(path)
+
+    x1, x2, y1, y2 = imagery.tileextent(tile)
+    return img, np.linspace(x1, x2, img.shape[1]), np.linspace(y1, y2, img.shape[0]), 'lower'
+
+def image(imagery, zoom, extent=LONDON):
+    """Like cartopy's `image_for_domain`, but fetches the tiles concurrently and caches each one"""
+    corners = imagery.crs.transform_points(ccrs.PlateCarree(), np.array(extent[:2]), np.array(extent[2:]))
+    (x1, y1), (x2, y2) = corners[:, :2]
+    domain = shapely.geometry.box(x1, y1, x2, y2)
+
+    tiles = list(imagery.find_images(domain, zoom))
+    with ThreadPoolExecutor(getattr(imagery, 'workers', WORKERS)) as pool:
+        fetched = [t for t in pool.map(partial(fetch_tile, imagery), tiles) if t is not None]
+    return img_tiles._merge_tiles(fetched)
+
+@metrics.autocache()
 def timmap(target, zoom=12, interval=5):
     imagery = TIM(target, travelTimeInterval=interval)
-
-    ax = plt.axes(projection=imagery.crs)
-    ax.set_extent(LONDON)
-
-    extent = ax._get_extent_geom(imagery.crs)
-    img, extent, origin = imagery.image_for_domain(extent, zoom)
-
-    plt.close(ax.figure)
+    img, extent, origin = image(imagery, zoom)
 
     # Swap from colors to integers
-    bands = np.full_like(img[:, :, 0], 255)
-    for i, c in enumerate(COLORS):
-        bands[(img == 255*mpl.colors.to_rgba_array(c)[0, :3]).all(-1)] = i
+    bands = geo.decode(img, COLORS)
         
     # Replace the boundaries - which are a mix of colors - with the nearest solid color
-    while (bands == 255).any():
-        dilated = scipy.ndimage.grey_erosion(bands, size=3)
-        bands[bands == 255] = dilated[bands == 255]
+    bands = geo.fill(bands, bands == 255, 'min')
 
     times = interval/2 + interval*np.arange(len(COLORS), dtype=float)
     times[-1] = np.inf
@@ -69,15 +132,9 @@ def timmap(target, zoom=12, interval=5):
 
     return {'img': bands, 'extent': extent, 'origin': origin}
 
-@aljpy.autocache()
+@metrics.autocache()
 def basemap(zoom=12):
-    imagery = OSM()
-
-    ax = plt.axes(projection=imagery.crs)
-    ax.set_extent(LONDON)
-    extent = ax._get_extent_geom(imagery.crs)
-    img, extent, origin = imagery.image_for_domain(extent, zoom)
-    plt.close(ax.figure)
+    img, extent, origin = image(Basemap(), zoom)
 
     return {'img': img, 'extent': extent, 'origin': origin}
 
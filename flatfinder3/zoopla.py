@@ -3,18 +3,27 @@ import pandas as pd
 import time
 import json
 import requests
+import threading
+import fcntl
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
-from .webcat import LONDON
-from . import dataframe
-import numpy as np
-from bs4 import BeautifulSoup
-import aljpy
+from functools import lru_cache
+from . import dataframe, store, grid, tiles, lazy, metrics
+from pyarrow import feather
+
+bs4 = lazy.module('bs4')
 
 WEEKS_PER_MONTH = 365/12./7
 
 API_WINDOW = 60*60#seconds
 API_LIMIT = 100
-GRID_RES = 6
+API_BURST = 10
+WORKERS = 4
+
+PHOTO_WORKERS = 4
+PHOTO_RETRIES = 4
+PHOTO_FAILURE_TTL = 24*3600
+PHOTO_LIMIT = 2*1024**3 #bytes
 
 PARAMS = {
     'order_by': 'age',
@@ -22,150 +31,292 @@ PARAMS = {
     'listing_status': 'rent',
     'furnished': 'furnished',
     'page_size': 100,
-    'summarised': True,
-    'api_key': json.load(open('credentials.json'))['zoopla_key']      
-}
+    'summarised': True}
+
+CREDENTIALS = Path('credentials.json')
 
 CACHE = Path('.cache/zoopla')
+SNAPSHOTS = CACHE / 'snapshots'
+KEEP_SNAPSHOTS = 5
 
 ZOOPLA_URL = 'http://api.zoopla.co.uk/api/v1/property_listings.js'
 
-def throttle():
-    cache = CACHE / 'zoopla-calls.json'
-    if not cache.exists():
-        cache.parent.mkdir(parents=True, exist_ok=True)
-        cache.write_text(r'[]')
-    while True:
-        calls = json.loads(cache.read_text())
-        recent = [c for c in calls if time.time() - c < API_WINDOW]
-        if (len(recent) < API_LIMIT):
-            break
-        time.sleep(1)
-    recent.append(time.time())
-    cache.write_text(json.dumps(recent))
+API_CALLS = metrics.counter('flatfinder_api_calls_total', 'Calls made to the Zoopla API', ['status'])
+THROTTLE_SECONDS = metrics.histogram('flatfinder_throttle_seconds', 'Time spent waiting on the API budget')
+PAGES = metrics.histogram('flatfinder_pages_per_cell', 'Pages fetched per cell search', buckets=(1, 2, 5, 10, 20, 50, 100, float('inf')))
+
+SESSION = requests.Session()
+SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=WORKERS + PHOTO_WORKERS))
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=WORKERS + PHOTO_WORKERS))
+
+@lru_cache()
+def api_key():
+    """Only read when there's a call to make, so the server can import this without any credentials about"""
+    return json.loads(CREDENTIALS.read_text())['zoopla_key']
 
-def listings():
-    path = CACHE / 'listings.json'
-    if not path.exists():
-        return pd.DataFrame()
-    data = json.loads(path.read_text())
-    return pd.json_normalize(data.values())
+class TokenBucket:
+    """Hands out API calls in the order they're asked for. Each caller reserves the next slot and sleeps 
+    until it's due, so there's no polling. Refilling at `(limit - burst)/window` with room for `burst` 
+    means no window ever sees more than `limit` calls. The level's kept in a file that's re-read and saved under 
+    a file lock on every call, so restarting doesn't get you a fresh allowance and a notebook `search()` shares 
+    the budget with a running `loop()`."""
 
-def grid_center(i):
-    x1, x2, y1, y2 = LONDON
+    def __init__(self, path, limit=API_LIMIT, burst=API_BURST, window=API_WINDOW):
+        self._path = path
+        self._burst = burst
+        self._rate = (limit - burst)/window
+        self._lock = threading.Lock()
 
-    xd = (x2 - x1)/GRID_RES
-    xs = np.arange(x1 + xd/2, x2, xd)
+    def _load(self):
+        if not self._path.exists():
+            return self._burst, time.time()
+        state = json.loads(self._path.read_text())
+        if isinstance(state, list):
+            # Old format: the list of recent call times. Treat it as having drained the bucket.
+            return (0 if state else self._burst), max(state, default=time.time())
+        return state['tokens'], state['stamp']
 
-    yd = (y2 - y1)/GRID_RES
-    ys = np.arange(y1 + yd/2, y2, yd)
+    def _save(self, tokens, stamp):
+        self._path.with_suffix('.tmp').write_text(json.dumps({'tokens': tokens, 'stamp': stamp}))
+        self._path.with_suffix('.tmp').replace(self._path)
 
-    centers = np.stack(np.meshgrid(xs, ys), -1).reshape(-1, 2)
+    def acquire(self):
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        # The state file's replaced on every save, so the lock's taken on a file of its own
+        with self._lock, open(self._path.with_suffix('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            tokens, stamp = self._load()
+            now = time.time()
+            tokens = min(self._burst, tokens + (now - stamp)*self._rate) - 1
+            self._save(tokens, now)
+            wait = max(0, -tokens/self._rate)
+        time.sleep(wait)
+        return wait
 
-    y_km = 6400*2*np.pi/360*yd
-    x_km = 6400*2*np.pi/360*np.cos(np.pi/180*(y1 + y2)/2)*xd
-    rad = (y_km**2 + x_km**2)**.5 / 2 / 1.6 * 1.05 # Overdo it a bit
+BUCKET = TokenBucket(CACHE / 'zoopla-calls.json')
 
-    return centers[i], rad
+PREFETCHER = ThreadPoolExecutor(PHOTO_WORKERS)
+
+def throttle():
+    wait = BUCKET.acquire()
+    THROTTLE_SECONDS.observe(wait)
+    return wait
 
-def search_page(grid_idx, page=0):
+@metrics.timed('listings')
+def listings(since=None):
+    return store.load(since)
+
+def search_page(cell, page=0):
     throttle()
-    center, rad = grid_center(grid_idx)
+    center, rad = grid.circle(grid.cells()[cell]['bounds'])
     params = {'longitude': center[0], 'latitude': center[1], 'radius': rad}
-    r = requests.get(ZOOPLA_URL, {**PARAMS, **params, 'page_number': page})
+    r = SESSION.get(ZOOPLA_URL, params={**PARAMS, **params, 'api_key': api_key(), 'page_number': page})
+    API_CALLS.inc(status=r.status_code)
     r.raise_for_status()
     raw = json.loads(r.content)
 
-    path = CACHE / 'listings.json'
-    if not path.exists():
-        path.parent.mkdir(exist_ok=True)
-        path.write_text('{}')
-    cache = json.loads(path.read_text())
+    if not raw['listing']:
+        print(f'{cell}/{page}: empty')
+        return None, True, raw['result_count']
+
     for listing in raw['listing']:
-        listing['grid_index'] = grid_idx
-        cache[listing['listing_id']] = listing
-    path.with_suffix('.tmp').write_text(json.dumps(cache))
-    path.with_suffix('.tmp').rename(path)
+        listing['grid_index'] = cell
+    store.upsert([store.compact(l) for l in raw['listing']])
 
     earliest = pd.Timestamp(min(l['last_published_date'] for l in raw['listing']))
     latest = pd.Timestamp(max(l['last_published_date'] for l in raw['listing']))
-    print(f'{grid_idx}/{page}: covered {earliest} to {latest}')
+    print(f'{cell}/{page}: covered {earliest} to {latest}')
 
     done = raw['result_count'] <= page*PARAMS['page_size']
-    return earliest, done
+    return earliest, done, raw['result_count']
+
+@metrics.timed('cache_dataframe')
+def cache_dataframe(full=False, photos=True):
+    """Only looks up the map layers for listings fetched since the last call, unless the layers themselves 
+    have changed or `full` is set. The cuts and filters are left for the server to apply."""
+    enriched, meta = CACHE / 'enriched.pkl', CACHE / 'enriched.json'
+    CACHE.mkdir(exist_ok=True, parents=True)
+
+    key = dataframe.layer_key()
+    state = json.loads(meta.read_text()) if meta.exists() else {}
+    if full or (state.get('key') != key) or not enriched.exists():
+        old, since = None, None
+    else:
+        old, since = pd.read_pickle(enriched), state['fetched']
+
+    fetched = time.time()
+    ls = listings(since)
+    if (old is not None) and not len(ls) and version():
+        print('Nothing new or updated')
+        return
+
+    new = dataframe.update(old, ls)
+    print(f'Enriched {len(ls)} new or updated listings' if old is not None else f'Rebuilt from {len(ls)} listings')
+
+    pd.to_pickle(new, enriched.with_suffix('.tmp'))
+    enriched.with_suffix('.tmp').rename(enriched)
+    meta.write_text(json.dumps({'key': key, 'fetched': fetched}))
+
+    df = dataframe.finish(new)
+    save_snapshot(df)
+    print(f'Rendered {tiles.prerender(dataframe.select(df), dataframe.basemap())} thumbnails')
+    if photos:
+        prefetch(dataframe.select(df))
+
+def save_snapshot(df):
+    """Writes `df` as a new snapshot, then points `CURRENT` at it. Both are renames into place, so a reader only ever 
+    sees a complete snapshot. Snapshots are uncompressed Feather so they can be memory-mapped rather than parsed."""
+    SNAPSHOTS.mkdir(exist_ok=True, parents=True)
+    version = str(time.time_ns())
+    tmp = SNAPSHOTS / f'{version}.tmp'
+    feather.write_feather(df.reset_index(drop=True), tmp, compression='uncompressed')
+    tmp.replace(SNAPSHOTS / f'{version}.feather')
 
-def cache_dataframe():
-    ls = listings()
-    df = dataframe.dataframe(ls)
-    cache = CACHE / 'dataframe.pkl'
-    if not cache.parent.exists():
-        cache.parent.mkdir(exist_ok=True, parents=True)
-    pd.to_pickle(df, cache)
+    pointer = SNAPSHOTS / 'CURRENT.tmp'
+    pointer.write_text(version)
+    pointer.replace(SNAPSHOTS / 'CURRENT')
+
+    # Keep a few old ones around for any readers that are halfway through loading them
+    for path in sorted(SNAPSHOTS.glob('*.feather'))[:-KEEP_SNAPSHOTS]:
+        path.unlink()
+    return version
+
+def version():
+    """The version of the latest snapshot. It's a read of a few bytes, so it's cheap enough to check every request."""
+    pointer = SNAPSHOTS / 'CURRENT'
+    return pointer.read_text() if pointer.exists() else ''
+
+@lru_cache(maxsize=2)
+def snapshot(version):
+    if not version:
+        # From before there were snapshots
+        return pd.read_pickle(CACHE / 'dataframe.pkl')
+    return feather.read_table(SNAPSHOTS / f'{version}.feather', memory_map=True).to_pandas()
 
-@aljpy.autocache(disk=False, memory=True, duration=600)
 def load_dataframe():
-    cache = CACHE / 'dataframe.pkl'
-    return pd.read_pickle(cache)
-
-def search():
-    for i in range(GRID_RES**2):
-        page = 1
-        ls = listings()
-        latest = pd.Timestamp('2020-05-01')
-        if ls.size:
-            ls = ls.loc[lambda df: df.grid_index == i]
-            if ls.size:
-                latest = pd.Timestamp(ls.last_published_date.max())
-
-        while True:
-            try:
-                earliest, done = search_page(i, page)
-            except:
-                print(f'{i}: failed, retrying')
-            else:
-                time.sleep(1)
-                if done:
-                    print(f'{i}: fetched all listings')
-                    break
-                if pd.Timestamp(earliest) < latest:
-                    print(f'{i}: fetched all recent listings')
-                    break
-
-                page = page + 1
-                if page == 100:
-                    print(f'{i}: ran out of pages')
-                    break
+    return snapshot(version())
+
+def search_cell(cell):
+    page = 1
+    latest = pd.Timestamp(store.latest(cell) or '2020-05-01')
+
+    while True:
+        try:
+            earliest, done, count = search_page(cell, page)
+        except:
+            print(f'{cell}: failed, retrying')
+        else:
+            if done:
+                print(f'{cell}: fetched all listings')
+                break
+            if pd.Timestamp(earliest) < latest:
+                print(f'{cell}: fetched all recent listings')
+                break
+
+            page = page + 1
+            if page == 100:
+                print(f'{cell}: ran out of pages')
+                break
+    PAGES.observe(page)
+    return count
+
+def search(workers=WORKERS):
+    partition = grid.cells()
+    with ThreadPoolExecutor(workers) as pool:
+        counts = dict(zip(partition, pool.map(search_cell, partition)))
+    grid.repartition(counts)
+    metrics.save('scraper')
             
 def loop():
+    """Refreshes cells in order of how many new listings they're expected to have, and re-caches the dataframe 
+    whenever something new turns up"""
     print('Started')
-    nxt = time.time()
     while True:
-        if time.time() > nxt:
-            search()
+        cell, wait = grid.due(grid.cells(), store.rates(), budget=API_LIMIT - API_BURST)
+        if wait > 0:
+            time.sleep(min(wait, 60))
+            continue
 
+        start = time.time()
+        count = search_cell(cell)
+        grid.repartition({cell: count})
+
+        if store.fetched(start):
             print('Caching dataframe')
             cache_dataframe()
+        metrics.save('scraper')
 
-            print('Sleeping for six hours before the next search')
-            nxt = time.time() + 6*3600
-        time.sleep(15)
+def _fetch(url, retries=PHOTO_RETRIES):
+    for attempt in range(retries):
+        try:
+            r = SESSION.get(url, timeout=30)
+            r.raise_for_status()
+            return r
+        except requests.RequestException:
+            if attempt == retries - 1:
+                raise
+            time.sleep(2**attempt)
 
-def photo(lid, filename):
+def photo(lid, filename, retries=1):
     url = f'https://lid.zoocdn.com/645/430/{filename}'
     path = CACHE / 'photos' / lid / filename
-    if not path.exists():
-        if not path.parent.exists():
-            path.parent.mkdir(exist_ok=True, parents=True)
-        r = requests.get(url)
-        if r.status_code == 200:
-            path.write_bytes(r.content)
-        else:
-            print(f'Couldn\'t fetch {url}')
-            path.write_bytes(b'')        
-    return path.read_bytes()
-
-@aljpy.autocache()
-def photo_filenames(lid):
-    r = requests.get(f'https://www.zoopla.co.uk/to-rent/details/{lid}')
-    soup = BeautifulSoup(r.content, features='html5lib')
-    return [t.attrs['src'].split('/')[-1] for t in soup.select(".dp-gallery__image")]
\ No newline at end of file
+    failed = path.with_name(path.name + '.failed')
+    # Files left empty by old failures are treated as missing
+    if path.exists() and path.stat().st_size:
+        # Touching it keeps the LRU pruning in `prune_photos` honest
+        path.touch()
+        return path.read_bytes()
+    if failed.exists() and (time.time() - failed.stat().st_mtime < PHOTO_FAILURE_TTL):
+        return b''
+
+    path.parent.mkdir(exist_ok=True, parents=True)
+    try:
+        content = _fetch(url, retries).content
+    except requests.RequestException:
+        print(f'Couldn\'t fetch {url}')
+        failed.touch()
+        return b''
+    path.with_name(path.name + '.tmp').write_bytes(content)
+    path.with_name(path.name + '.tmp').replace(path)
+    failed.unlink(missing_ok=True)
+    return content
+
+@metrics.autocache('{lid}')
+def photo_filenames(lid, retries=1):
+    """A listing that's been taken down has an empty gallery, and that's cached like any other. Only the background
+    prefetch asks for retries, so a page view never sits through the backoff."""
+    try:
+        r = _fetch(f'https://www.zoopla.co.uk/to-rent/details/{lid}', retries)
+    except requests.HTTPError as e:
+        if e.response.status_code == 404:
+            return []
+        raise
+    soup = bs4.BeautifulSoup(r.content, features='html5lib')
+    return [t.attrs['src'].split('/')[-1] for t in soup.select(".dp-gallery__image")]
+
+def prune_photos(limit=PHOTO_LIMIT):
+    """Deletes the least-recently-used photos until the photo cache is under `limit` bytes"""
+    files = [(p.stat(), p) for p in (CACHE / 'photos').glob('*/*') if p.is_file()]
+    total = sum(s.st_size for s, _ in files)
+    for s, p in sorted(files, key=lambda f: f[0].st_mtime):
+        if total <= limit:
+            break
+        p.unlink(missing_ok=True)
+        total -= s.st_size
+
+def _prefetch(lid):
+    try:
+        for filename in photo_filenames(lid, retries=PHOTO_RETRIES):
+            photo(lid, filename, retries=PHOTO_RETRIES)
+    except Exception as e:
+        print(f'{lid}: prefetch failed, {e}')
+
+def _prune_after(futures):
+    wait(futures)
+    prune_photos()
+
+def prefetch(df):
+    """Fetches the galleries and photos for every listing in `df` in the background"""
+    futures = [PREFETCHER.submit(_prefetch, str(lid)) for lid in df.listing_id]
+    # Everything ahead of this in the queue has been picked up by the time it runs, so waiting can't deadlock
+    PREFETCHER.submit(_prune_after, futures)